@@ -0,0 +1,257 @@
+'''
+: Run the real workflows against moto with injected latency and throttling
+: Report wall clock, API calls per operation and peak memory per fleet size
+: Needs moto: pip install "moto[ec2,rds,redshift]"
+
+'''
+import argparse
+import contextlib
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from common import rate_limiter
+from common.aws_clients import register_client_hook
+
+sizes = [10, 100, 1000, 10000]
+
+
+def setup_client(service_name):
+    import boto3
+
+    # plain clients, so the fixtures skip the fake latency and the rate limiter
+    return boto3.client(service_name)
+
+
+def setup_instances(n):
+    ec2 = setup_client('ec2')
+    for i in range(0, n, 1000):
+        count = min(1000, n - i)
+        ec2.run_instances(
+            ImageId='ami-12345678', MinCount=count, MaxCount=count,
+            BlockDeviceMappings=[{'DeviceName': '/dev/xvda', 'Ebs': {'VolumeSize': 8}}],
+            TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': 'FSS'}]}])
+
+    rows = []
+    paginator = ec2.get_paginator('describe_volumes')
+    for page in paginator.paginate(Filters=[{'Name': 'attachment.device', 'Values': ['/dev/xvda']}]):
+        for volume in page['Volumes']:
+            rows.append({'instance_id': volume['Attachments'][0]['InstanceId'],
+                         'volume_id': volume['VolumeId'], 'device': '/dev/xvda', 'size': volume['Size'],
+                         'AvailabilityZone': volume['AvailabilityZone'], 'instance_state': 'running'})
+    return rows
+
+
+def setup_snapshots(n):
+    ec2 = setup_client('ec2')
+    for i in range(n):
+        volume = ec2.create_volume(AvailabilityZone='ap-south-1a', Size=8)
+        ec2.create_snapshot(VolumeId=volume['VolumeId'])
+
+
+def setup_clusters(n, backend):
+    redshift = setup_client('redshift')
+    # the backend keeps the pause events the pause snapshot copy looks for
+    backend.attach(redshift)
+    for i in range(n):
+        redshift.create_cluster(ClusterIdentifier=f'cluster-{i}', NodeType='dc2.large',
+                                MasterUsername='admin', MasterUserPassword='Passw0rd!',
+                                ClusterType='single-node')
+        # every other cluster is paused, right after the automated snapshot taken at its creation
+        if i % 2:
+            redshift.pause_cluster(ClusterIdentifier=f'cluster-{i}')
+    return [(f'cluster-{i}', None) for i in range(n)]
+
+
+def setup_db_instances(n):
+    ec2 = setup_client('ec2')
+    rds = setup_client('rds')
+    subnets = [s['SubnetId'] for s in ec2.describe_subnets()['Subnets']][:2]
+    rds.create_db_subnet_group(DBSubnetGroupName='bench', DBSubnetGroupDescription='bench',
+                               SubnetIds=subnets)
+    rds.create_option_group(OptionGroupName='bench', EngineName='mysql', MajorEngineVersion='8.0',
+                            OptionGroupDescription='bench')
+    rds.create_db_parameter_group(DBParameterGroupName='bench', DBParameterGroupFamily='mysql8.0',
+                                  Description='bench')
+    targets = ['prd'] + [f'qa{i}' for i in range(n)]
+    for identifier in targets:
+        rds.create_db_instance(DBInstanceIdentifier=identifier, DBInstanceClass='db.t3.micro',
+                               Engine='mysql', MasterUsername='admin', MasterUserPassword='Passw0rd!',
+                               AllocatedStorage=20, DBSubnetGroupName='bench',
+                               OptionGroupName='bench', DBParameterGroupName='bench')
+    return targets[1:]
+
+
+def bench_get_instance_details(n, args, backend):
+    from ec2 import get_instance_details
+
+    setup_instances(n)
+    yield
+    get_instance_details.get_instances()
+
+
+def bench_encrypt_ebs(n, args, backend):
+    from ec2 import encrypt_ebs
+    from ec2.journal import Journal
+
+    rows = setup_instances(n)
+    encrypt_ebs.waiter.delay = args.poll_delay
+    yield
+    with Journal(os.path.join(os.getcwd(), 'journal.jsonl')) as journal:
+        data = encrypt_ebs.encrypt_fleet(encrypt_ebs.group_instances(rows), journal,
+                                         max_workers=args.workers)
+    return sum(row[-1] != 'success' for row in data)
+
+
+def bench_encrypt_snapshot(n, args, backend):
+    from ec2 import encrypt_snapshot
+
+    setup_snapshots(n)
+    encrypt_snapshot.waiter.delay = args.poll_delay
+    yield
+    _, failed = encrypt_snapshot.encrypt_snapshots(encrypt_snapshot.get_unencrypted_snapshots())
+    return len(failed)
+
+
+def bench_terminate_redshift_cluster(n, args, backend):
+    from redshift import terminate_redshift_cluster
+
+    targets = setup_clusters(n, backend)
+    yield
+    results = terminate_redshift_cluster.decommission_clusters(
+        targets, 90, max_workers=args.workers, snapshot_on_delete=args.snapshot_on_delete)
+    return sum(result['status'] != 'deleted' for result in results)
+
+
+def bench_restore_snapshot(n, args, backend):
+    from rds import restore_snapshot
+
+    targets = setup_db_instances(n)
+    restore_args = ('db.t3.micro', 3306, 'ap-south-1a', 'bench', False, False, True,
+                    'general-public-license', 'mysql', 'bench', 'gp2', [], 'bench',
+                    'region', 'IPV4', [])
+    yield
+    restore_snapshot.refresh_workflow({target: restore_args for target in targets}).run()
+
+
+workflows = {
+    'get_instance_details': bench_get_instance_details,
+    'encrypt_ebs': bench_encrypt_ebs,
+    'encrypt_snapshot': bench_encrypt_snapshot,
+    'terminate_redshift_cluster': bench_terminate_redshift_cluster,
+    'restore_snapshot': bench_restore_snapshot,
+}
+
+
+def run(workflow, n, backend, args):
+    """
+    Runs one workflow for a fleet of n resources in a fresh moto account.
+
+    The setup before the workflow's yield is not measured. The workflow
+    returns how many of its items failed, reported as the run's error.
+
+    Returns:
+        dict: Wall clock, API calls per operation, throttles and peak memory.
+    """
+    from moto import mock_aws
+
+    settings = backend.latency, backend.throttle_rate, backend.transition_seconds
+    with mock_aws(), tempfile.TemporaryDirectory() as workdir, \
+            contextlib.redirect_stdout(open(os.devnull, 'w')):
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            backend.latency, backend.throttle_rate, backend.transition_seconds = 0, 0, 0
+            steps = workflows[workflow](n, args, backend)
+            next(steps)
+            backend.latency, backend.throttle_rate, backend.transition_seconds = settings
+            backend.reset()
+
+            tracemalloc.start()
+            started = time.perf_counter()
+            error = None
+            try:
+                next(steps)
+            except StopIteration as done:
+                if done.value:
+                    error = f'{done.value} of {n} failed'
+            except Exception as e:
+                error = str(e)
+            seconds = time.perf_counter() - started
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        finally:
+            os.chdir(cwd)
+
+    return {
+        'workflow': workflow,
+        'size': n,
+        'seconds': round(seconds, 3),
+        'api_calls': sum(backend.calls.values()),
+        'throttled': sum(backend.throttled.values()),
+        'peak_memory_mb': round(peak / 1024 / 1024, 2),
+        'calls': {f'{service}.{operation}': count
+                  for (service, operation), count in backend.calls.most_common()},
+        'error': error,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the workflows against a local fake AWS backend')
+    parser.add_argument('--workflows', nargs='+', default=list(workflows), choices=list(workflows))
+    parser.add_argument('--sizes', nargs='+', type=int, default=sizes)
+    parser.add_argument('--latency', type=float, default=0.02,
+                        help='seconds added to every API call')
+    parser.add_argument('--throttle-rate', type=float, default=0.0,
+                        help='fraction of API calls answered with a throttling error')
+    parser.add_argument('--transition-seconds', type=float, default=1.0,
+                        help='seconds a changed resource reports its transition state, e.g. stopping')
+    parser.add_argument('--workers', type=int, default=32,
+                        help='worker pool size of the parallel workflows')
+    parser.add_argument('--poll-delay', type=float, default=0.1,
+                        help='tick of the batched EC2 waiter')
+    parser.add_argument('--rate-limit', action='store_true',
+                        help='run with the shared per-action rate limiter, like the scripts do')
+    parser.add_argument('--snapshot-on-delete', action='store_true',
+                        help='let delete_cluster take the final Redshift snapshots')
+    parser.add_argument('--output', help='write the results as json for regression tracking')
+    args = parser.parse_args()
+
+    # fake credentials so nothing can reach a real account, and a small ec2 backend
+    os.environ.update(AWS_ACCESS_KEY_ID='testing', AWS_SECRET_ACCESS_KEY='testing',
+                      AWS_DEFAULT_REGION='ap-south-1', MOTO_EC2_LOAD_DEFAULT_AMIS='false')
+    os.environ.pop('AWS_PROFILE', None)
+    from bench.fake_aws import FakeBackend
+
+    logging.disable(logging.INFO)
+    backend = FakeBackend(latency=args.latency, throttle_rate=args.throttle_rate,
+                          transition_seconds=args.transition_seconds)
+    register_client_hook(backend.attach)
+    if args.rate_limit:
+        rate_limiter.enable()
+
+    results = []
+    print(f"{'WORKFLOW':<28} {'SIZE':>6} {'SECONDS':>9} {'CALLS':>8} {'THROTTLED':>9} {'PEAK MB':>8}  TOP CALLS")
+    for workflow in args.workflows:
+        for n in args.sizes:
+            result = run(workflow, n, backend, args)
+            results.append(result)
+            top = ', '.join(f'{op}={count}' for op, count in list(result['calls'].items())[:3])
+            print(f"{workflow:<28} {n:>6} {result['seconds']:>9} {result['api_calls']:>8} "
+                  f"{result['throttled']:>9} {result['peak_memory_mb']:>8}  "
+                  f"{result['error'] and 'ERROR: ' + result['error'] or top}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
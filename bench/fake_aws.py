@@ -0,0 +1,256 @@
+'''
+: Local stand-in for AWS used by the benchmarks
+: moto keeps the resource state, a before-send hook adds per-call
+: latency, random throttling and the calls moto does not implement, and
+: resources report their transition state for a while after a change
+
+'''
+import random
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+from io import BytesIO
+from urllib.parse import parse_qs
+from xml.sax.saxutils import escape
+
+from botocore.awsrequest import AWSResponse
+
+THROTTLE_ERRORS = {
+    'ec2': (503, b'<Response><Errors><Error><Code>RequestLimitExceeded</Code>'
+                 b'<Message>Request limit exceeded.</Message></Error></Errors>'
+                 b'<RequestID>fake</RequestID></Response>'),
+    'query': (400, b'<ErrorResponse><Error><Type>Sender</Type><Code>Throttling</Code>'
+                   b'<Message>Rate exceeded</Message></Error>'
+                   b'<RequestId>fake</RequestId></ErrorResponse>'),
+    'json': (400, b'{"__type": "ThrottlingException", "message": "Rate exceeded"}'),
+}
+
+# calls used by the scripts that moto does not implement, answered with an empty result
+NOT_IN_MOTO = {
+    ('redshift', 'ModifyClusterSnapshot'):
+        b'<ModifyClusterSnapshotResponse><ModifyClusterSnapshotResult>'
+        b'</ModifyClusterSnapshotResult></ModifyClusterSnapshotResponse>',
+}
+
+# mutating call -> (kind of resource, its ids from the params and the response,
+# the state it reports until the transition is over); moto finishes every
+# change at once, deletions still do
+TRANSITIONS = {
+    ('ec2', 'StopInstances'): ('ec2_instance', lambda params, parsed: params['InstanceIds'], 'stopping'),
+    ('ec2', 'StartInstances'): ('ec2_instance', lambda params, parsed: params['InstanceIds'], 'pending'),
+    ('ec2', 'CreateSnapshot'): ('ec2_snapshot', lambda params, parsed: [parsed['SnapshotId']], 'pending'),
+    ('ec2', 'CopySnapshot'): ('ec2_snapshot', lambda params, parsed: [parsed['SnapshotId']], 'pending'),
+    ('ec2', 'CreateVolume'): ('ec2_volume', lambda params, parsed: [parsed['VolumeId']], 'creating'),
+    ('ec2', 'DetachVolume'): ('ec2_volume', lambda params, parsed: [params['VolumeId']], 'in-use'),
+    ('ec2', 'AttachVolume'): ('ec2_volume', lambda params, parsed: [params['VolumeId']], 'available'),
+    ('rds', 'CreateDBSnapshot'):
+        ('rds_snapshot', lambda params, parsed: [params['DBSnapshotIdentifier']], 'creating'),
+    ('rds', 'RestoreDBInstanceFromDBSnapshot'):
+        ('rds_instance', lambda params, parsed: [params['DBInstanceIdentifier']], 'creating'),
+    ('rds', 'ModifyDBInstance'):
+        ('rds_instance', lambda params, parsed: [params.get('NewDBInstanceIdentifier',
+                                                            params['DBInstanceIdentifier'])], 'modifying'),
+    ('redshift', 'PauseCluster'):
+        ('redshift_cluster', lambda params, parsed: [params['ClusterIdentifier']], 'pausing'),
+    ('redshift', 'ResumeCluster'):
+        ('redshift_cluster', lambda params, parsed: [params['ClusterIdentifier']], 'resuming'),
+    ('redshift', 'CreateClusterSnapshot'):
+        ('redshift_snapshot', lambda params, parsed: [params['SnapshotIdentifier']], 'creating'),
+    ('redshift', 'CopyClusterSnapshot'):
+        ('redshift_snapshot', lambda params, parsed: [params['TargetSnapshotIdentifier']], 'creating'),
+}
+
+# describe call -> (kind of resource, the resources in the response, id key, state keys)
+DESCRIBES = {
+    ('ec2', 'DescribeInstances'):
+        ('ec2_instance', lambda parsed: [instance for reservation in parsed['Reservations']
+                                         for instance in reservation['Instances']],
+         'InstanceId', ('State', 'Name')),
+    ('ec2', 'DescribeVolumes'): ('ec2_volume', lambda parsed: parsed['Volumes'], 'VolumeId', ('State',)),
+    ('ec2', 'DescribeSnapshots'): ('ec2_snapshot', lambda parsed: parsed['Snapshots'], 'SnapshotId', ('State',)),
+    ('rds', 'DescribeDBInstances'):
+        ('rds_instance', lambda parsed: parsed['DBInstances'], 'DBInstanceIdentifier', ('DBInstanceStatus',)),
+    ('rds', 'DescribeDBSnapshots'):
+        ('rds_snapshot', lambda parsed: parsed['DBSnapshots'], 'DBSnapshotIdentifier', ('Status',)),
+    ('redshift', 'DescribeClusters'):
+        ('redshift_cluster', lambda parsed: parsed['Clusters'], 'ClusterIdentifier', ('ClusterStatus',)),
+    ('redshift', 'DescribeClusterSnapshots'):
+        ('redshift_snapshot', lambda parsed: parsed['Snapshots'], 'SnapshotIdentifier', ('Status',)),
+}
+
+# Redshift cluster events written for the calls that change the cluster state: (started, done)
+EVENTS = {
+    'PauseCluster': ('Cluster {} is being paused.', 'Cluster {} has been paused.'),
+    'ResumeCluster': ('Cluster {} is being resumed.', 'Cluster {} has been resumed.'),
+}
+
+
+class _RawResponse(BytesIO):
+
+    def stream(self, **kwargs):
+        contents = self.read()
+        while contents:
+            yield contents
+            contents = self.read()
+
+
+def _copy_cluster_snapshot(region_name, params):
+    import boto3
+
+    # a new snapshot of the source cluster stands in for the copy
+    boto3.client('redshift', region_name=region_name).create_cluster_snapshot(
+        SnapshotIdentifier=params['TargetSnapshotIdentifier'],
+        ClusterIdentifier=params['SourceSnapshotClusterIdentifier'])
+    return (b'<CopyClusterSnapshotResponse><CopyClusterSnapshotResult>'
+            b'</CopyClusterSnapshotResult></CopyClusterSnapshotResponse>')
+
+
+# calls moto does not implement, made with other calls of the same effect
+# on a plain client; they return the body of the response
+STAND_INS = {
+    ('redshift', 'CopyClusterSnapshot'): _copy_cluster_snapshot,
+}
+
+
+class FakeBackend:
+    """
+    Counts, delays and randomly throttles every request sent by a client.
+
+    After one of the TRANSITIONS a resource is reported in its transition
+    state (e.g. 'stopping' or 'creating') for transition_seconds, so the
+    waiters and polls have to look more than once, like against AWS. The
+    cluster pauses and resumes are kept as events for DescribeEvents.
+
+    Attach it with common.aws_clients.register_client_hook(backend.attach)
+    inside a moto mock_aws() context.
+    """
+
+    def __init__(self, latency=0.02, throttle_rate=0.0, transition_seconds=1.0, seed=0):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.transition_seconds = transition_seconds
+        self.calls = Counter()
+        self.throttled = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        # moto's backends are not thread safe, one request reaches them at a time
+        self._moto_lock = threading.RLock()
+        # kind -> resource id -> (monotonic end of the transition, state until then)
+        self._transitions = defaultdict(dict)
+        # cluster -> [(date, message)]
+        self._events = defaultdict(list)
+
+    def reset(self):
+        with self._lock:
+            self.calls.clear()
+            self.throttled.clear()
+
+    def _start_transition(self, service, operation, params, parsed):
+        if operation in EVENTS and service == 'redshift':
+            started = datetime.now(timezone.utc)
+            done = started.timestamp() + self.transition_seconds
+            with self._lock:
+                self._events[params['ClusterIdentifier']] += [
+                    (started, EVENTS[operation][0].format(params['ClusterIdentifier'])),
+                    (datetime.fromtimestamp(done, timezone.utc),
+                     EVENTS[operation][1].format(params['ClusterIdentifier']))]
+        if (service, operation) not in TRANSITIONS or not self.transition_seconds:
+            return
+        kind, get_ids, state = TRANSITIONS[(service, operation)]
+        until = time.monotonic() + self.transition_seconds
+        with self._lock:
+            for resource_id in get_ids(params, parsed):
+                # moto lower-cases the RDS identifiers
+                self._transitions[kind][resource_id.lower()] = (until, state)
+
+    def _report_transitions(self, service, operation, parsed):
+        kind, get_resources, id_key, state_keys = DESCRIBES[(service, operation)]
+        now = time.monotonic()
+        with self._lock:
+            transitions = self._transitions[kind]
+            if not transitions:
+                return
+            for resource in get_resources(parsed):
+                resource_id = resource[id_key].lower()
+                if resource_id not in transitions:
+                    continue
+                until, state = transitions[resource_id]
+                if now >= until:
+                    del transitions[resource_id]
+                    continue
+                for key in state_keys[:-1]:
+                    resource = resource[key]
+                resource[state_keys[-1]] = state
+
+    def _describe_events(self, params):
+        source = params.get('SourceIdentifier', [None])[0]
+        with self._lock:
+            events = [(cluster, date, message) for cluster, events in self._events.items()
+                      if source in (None, cluster) for date, message in events]
+        body = ''.join(
+            f'<Event><SourceIdentifier>{escape(cluster)}</SourceIdentifier><SourceType>cluster</SourceType>'
+            f'<Message>{escape(message)}</Message>'
+            f"<Date>{date.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}</Date></Event>"
+            for cluster, date, message in events)
+        return (f'<DescribeEventsResponse><DescribeEventsResult><Events>{body}</Events>'
+                f'</DescribeEventsResult></DescribeEventsResponse>').encode()
+
+    def attach(self, client):
+        from moto.core.models import botocore_stubber
+
+        protocol = client.meta.service_model.protocol
+        if protocol not in THROTTLE_ERRORS:
+            protocol = 'json' if 'json' in protocol else 'query'
+
+        def before_send(request, event_name, **kwargs):
+            _, service, operation = event_name.split('.')
+            with self._lock:
+                self.calls[(service, operation)] += 1
+                throttle = self._random.random() < self.throttle_rate
+                if throttle:
+                    self.throttled[(service, operation)] += 1
+
+            time.sleep(self.latency)
+            if throttle:
+                status, body = THROTTLE_ERRORS[protocol]
+            elif (service, operation) in NOT_IN_MOTO:
+                status, body = 200, NOT_IN_MOTO[(service, operation)]
+            elif (service, operation) == ('redshift', 'DescribeEvents'):
+                status, body = 200, self._describe_events(parse_qs(_text(request.body)))
+            elif (service, operation) in STAND_INS:
+                params = {key: values[0] for key, values in parse_qs(_text(request.body)).items()}
+                with self._moto_lock:
+                    status, body = 200, STAND_INS[(service, operation)](client.meta.region_name, params)
+            else:
+                # answered here rather than by moto's own handler so that the calls
+                # can be serialized; the latency above is still spent concurrently
+                with self._moto_lock:
+                    response = botocore_stubber(event_name=event_name, request=request)
+                request.url = 'https://fake-aws.invalid/'
+                return response
+            # every before-send handler runs, so point the request away from
+            # moto's url patterns to keep it from executing the call as well
+            request.url = 'https://fake-aws.invalid/'
+            return AWSResponse(request.url, status, {}, _RawResponse(body))
+
+        def before_parameter_build(params, context, **kwargs):
+            context['fake_aws_params'] = dict(params)
+
+        def after_call(event_name, http_response, parsed, context, **kwargs):
+            if http_response.status_code >= 300:
+                return
+            _, service, operation = event_name.split('.')
+            if (service, operation) in DESCRIBES:
+                self._report_transitions(service, operation, parsed)
+            else:
+                self._start_transition(service, operation, context.get('fake_aws_params', {}), parsed)
+
+        # registered first so it runs before moto answers the request
+        client.meta.events.register_first('before-send', before_send)
+        client.meta.events.register('before-parameter-build', before_parameter_build)
+        client.meta.events.register('after-call', after_call)
+
+
+def _text(body):
+    return body.decode() if isinstance(body, bytes) else body or ''
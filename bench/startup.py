@@ -0,0 +1,69 @@
+'''
+: Time how long every aws-scripts command takes to start
+: Each command's --help runs in a fresh interpreter, the median of a few
+: runs is compared with the budget and the run fails if one is over
+
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from cli import COMMANDS
+
+# seconds a command may take to print its --help, interpreter start included
+BUDGET = 0.3
+
+
+def time_command(argv, runs):
+    """Median wall clock of running argv in a fresh interpreter."""
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable] + argv, cwd=root, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Time the start of every aws-scripts command against a budget')
+    parser.add_argument('--budget', type=float, default=BUDGET,
+                        help='seconds a command may take to print its --help')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs per command, the median is reported')
+    parser.add_argument('--output', help='write the results as json for regression tracking')
+    args = parser.parse_args()
+
+    cli = os.path.join(root, 'cli.py')
+    commands = [[]] + [[group, command] for group, commands in COMMANDS.items()
+                       for command in commands]
+    interpreter = time_command(['-c', 'pass'], args.runs)
+    print(f"{'COMMAND':<40} {'SECONDS':>8}")
+    print(f"{'(python -c pass)':<40} {interpreter:>8.3f}")
+
+    results = []
+    for command in commands:
+        seconds = time_command([cli] + command + ['--help'], args.runs)
+        over = seconds > args.budget
+        results.append({'command': ' '.join(command), 'seconds': round(seconds, 3), 'over_budget': over})
+        print(f"{' '.join(command) or '(list commands)':<40} {seconds:>8.3f}{'  OVER BUDGET' if over else ''}")
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    over = [result for result in results if result['over_budget']]
+    print(f'*** {len(results) - len(over)} of {len(results)} commands start within {args.budget}s')
+    if over:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
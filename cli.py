@@ -0,0 +1,89 @@
+'''
+: One console command for all the scripts: aws-scripts <group> <command> [options]
+: Only the module of the chosen command is imported, so listing the commands
+: or asking for --help never pays for boto3 or pandas
+
+'''
+import importlib
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+prog = 'aws-scripts'
+
+# group -> command -> (module with a main(), one line of help)
+COMMANDS = {
+    'ec2': {
+        'get-instance-details': ('ec2.get_instance_details',
+                                 'write the unencrypted volumes of the tagged instances to a csv'),
+        'encrypt-ebs': ('ec2.encrypt_ebs', 'replace unencrypted volumes with encrypted copies'),
+        'encrypt-snapshot': ('ec2.encrypt_snapshot', 'make encrypted copies of unencrypted snapshots'),
+    },
+    'rds': {
+        'get-rds-details': ('rds.get_rds_details', 'print the details of an RDS instance'),
+        'restore-snapshot': ('rds.restore_snapshot', 'refresh a lower environment from a prd snapshot'),
+        'get-datasync-tasks': ('rds.get_datasync_task', 'list the DataSync tasks'),
+        'start-datasync-task': ('rds.start_data_sync_task', 'run DataSync tasks and report throughput'),
+    },
+    'redshift': {
+        'get-cluster-status': ('redshift.get_cluster_status', 'poll the status of a Redshift cluster'),
+        'terminate-cluster': ('redshift.terminate_redshift_cluster',
+                              'take a final snapshot and delete Redshift clusters'),
+    },
+    'inventory': {
+        'scan': ('inventory.scan_inventory', 'scan resources across profiles and regions to parquet'),
+    },
+    'bench': {
+        'workflows': ('bench.benchmark', 'benchmark the workflows against a fake AWS backend'),
+        'startup': ('bench.startup', 'time the start of every command against a budget'),
+    },
+}
+
+
+def usage(group=None):
+    lines = [f'usage: {prog} <group> <command> [options]', '']
+    for name, commands in COMMANDS.items():
+        if group and name != group:
+            continue
+        lines.append(f'{name}:')
+        for command, (_, help_text) in commands.items():
+            lines.append(f'  {command:<22} {help_text}')
+    lines.append('')
+    lines.append(f"run '{prog} <group> <command> --help' for the options of a command")
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] in ('-h', '--help'):
+        print(usage())
+        return 0 if argv else 2
+
+    group, rest = argv[0], argv[1:]
+    if group not in COMMANDS:
+        print(usage(), file=sys.stderr)
+        print(f'\n{prog}: unknown group {group!r}', file=sys.stderr)
+        return 2
+    if not rest or rest[0] in ('-h', '--help'):
+        print(usage(group))
+        return 0 if rest else 2
+
+    command, args = rest[0], rest[1:]
+    if command not in COMMANDS[group]:
+        print(usage(group), file=sys.stderr)
+        print(f'\n{prog}: unknown {group} command {command!r}', file=sys.stderr)
+        return 2
+
+    module_name = COMMANDS[group][command][0]
+    module = importlib.import_module(module_name)
+    # the api metrics are labelled as when the script is run directly, not after prog
+    from common import instrumentation
+    instrumentation.script_name = module_name.rsplit('.', 1)[-1]
+    # the command's own argparse reads sys.argv and names itself after prog
+    sys.argv = [f'{prog} {group} {command}'] + args
+    return module.main()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
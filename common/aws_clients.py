@@ -0,0 +1,130 @@
+import os
+import threading
+
+# botocore.config.Config arguments sized for the worker pools of the fleet
+# scripts; adaptive mode also rate limits the client side when AWS starts
+# throttling. boto3 itself is only imported once a client is needed.
+DEFAULT_CONFIG = {
+    'max_pool_connections': 50,
+    'retries': {
+        'max_attempts': 10,
+        'mode': 'adaptive'
+    }
+}
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+_client_hooks = []
+_environment_checked = False
+
+
+def register_client_hook(hook):
+    """
+    Calls hook(client) for every client get_client() has created or will create.
+
+    This is the place to attach botocore event handlers to all clients of a
+    run, e.g. for instrumentation or a simulated backend.
+
+    Args:
+        hook (callable): Receives each client once.
+
+    Returns:
+        None
+    """
+    with _lock:
+        _client_hooks.append(hook)
+        clients = list(_clients.values())
+    for client in clients:
+        hook(client)
+
+
+def get_session(profile_name=None, region_name=None):
+    """
+    Returns the shared session for a profile and region.
+
+    Args:
+        profile_name (str): The AWS credentials profile, None for the default chain.
+        region_name (str): The region, None for the profile's default.
+
+    Returns:
+        boto3.Session: The cached session.
+    """
+    import boto3
+
+    key = (profile_name, region_name)
+    with _lock:
+        if key not in _sessions:
+            _sessions[key] = boto3.Session(profile_name=profile_name,
+                                           region_name=region_name)
+        return _sessions[key]
+
+
+def get_client(service_name, profile_name=None, region_name=None, config=None):
+    """
+    Returns the shared client for a (profile, region, service).
+
+    Clients are created once, under a lock because sessions are not thread
+    safe, and can then be used from any number of worker threads so they
+    reuse the same connection pool. Setting AWS_API_METRICS_DIR turns on
+    common.instrumentation for all of them, and AWS_DESCRIBE_CACHE
+    common.describe_cache.
+
+    Args:
+        service_name (str): The AWS service, e.g. 'ec2' or 'redshift'.
+        profile_name (str): The AWS credentials profile, None for the default chain.
+        region_name (str): The region, None for the profile's default.
+        config (botocore.config.Config): Merged over the DEFAULT_CONFIG settings.
+
+    Returns:
+        botocore.client.BaseClient: The cached client.
+    """
+    global _environment_checked
+    if not _environment_checked:
+        _environment_checked = True
+        if os.environ.get('AWS_API_METRICS_DIR'):
+            from common.instrumentation import enable
+            enable(os.environ['AWS_API_METRICS_DIR'])
+        if os.environ.get('AWS_DESCRIBE_CACHE'):
+            from common import describe_cache
+            describe_cache.enable(os.environ['AWS_DESCRIBE_CACHE'])
+
+    key = (profile_name, region_name, service_name)
+    session = get_session(profile_name, region_name)
+    with _lock:
+        if key not in _clients:
+            from botocore.config import Config
+
+            client_config = Config(**DEFAULT_CONFIG)
+            if config:
+                client_config = client_config.merge(config)
+            client = session.client(service_name, config=client_config)
+            for hook in _client_hooks:
+                hook(client)
+            _clients[key] = client
+        return _clients[key]
+
+
+class LazyClient:
+    """
+    Stands in for get_client(...) until the client is first used.
+
+    Lets a module keep its client as a module level name without creating
+    it, or importing boto3, when the module is only imported.
+    """
+
+    def __init__(self, service_name, profile_name=None, region_name=None, config=None):
+        self._args = (service_name, profile_name, region_name, config)
+        self._client = None
+
+    def __getattr__(self, name):
+        if self._client is None:
+            self._client = get_client(*self._args)
+        return getattr(self._client, name)
+
+
+def lazy_client(service_name, profile_name=None, region_name=None, config=None):
+    """
+    Returns a LazyClient for get_client(service_name, profile_name, region_name, config).
+    """
+    return LazyClient(service_name, profile_name, region_name, config)
@@ -0,0 +1,255 @@
+'''
+: Opt-in on-disk cache of describe/list/get responses, shared by all scripts
+: Enabled by setting AWS_DESCRIBE_CACHE to the path of a SQLite file
+: Entries are keyed by account, region, operation and parameters, expire
+: after a per-operation TTL and are dropped when one of our own mutating
+: calls touches a resource they mention
+: Polls and status checks go through live() and always reach AWS
+
+'''
+import contextlib
+import json
+import threading
+import time
+from datetime import datetime
+
+from common.rate_limiter import action_category
+
+# seconds a response stays fresh, per operation
+DEFAULT_TTL = 300
+TTLS = {
+    'DescribeInstances': 300,
+    'DescribeVolumes': 300,
+    'DescribeSnapshots': 900,
+    'DescribeDBInstances': 300,
+    'DescribeDBSnapshots': 900,
+    'DescribeClusters': 300,
+    'DescribeClusterSnapshots': 900,
+    'ListTasks': 3600,
+    'DescribeTask': 3600,
+    # status reports that are polled, always asked
+    'DescribeTaskExecution': 0,
+    'GetCallerIdentity': 0,
+}
+
+# parameter and response keys holding resource ids; the owner filters only
+# narrow down a listing and request ids do not name a resource
+ID_SUFFIXES = ('Id', 'Ids', 'Identifier', 'Identifiers', 'Arn', 'Arns')
+NOT_RESOURCE_KEYS = {'OwnerId', 'OwnerIds', 'RestorableByUserIds', 'OwnerAccount', 'RequestId'}
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS responses (
+    account TEXT, region TEXT, service TEXT, operation TEXT, params TEXT,
+    scoped INTEGER, resources TEXT, expires REAL, response TEXT,
+    PRIMARY KEY (account, region, service, operation, params)
+);
+CREATE TABLE IF NOT EXISTS accounts (access_key TEXT PRIMARY KEY, account TEXT);
+'''
+
+
+_live = threading.local()
+
+
+@contextlib.contextmanager
+def live():
+    """
+    Sends the calls made inside, on this thread, to AWS instead of serving
+    them from the cache; their responses still refresh it.
+
+    For polls and the status checks that decide what to do next, which
+    must not see a state that is up to a TTL old.
+    """
+    depth = getattr(_live, 'depth', 0)
+    _live.depth = depth + 1
+    try:
+        yield
+    finally:
+        _live.depth = depth
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    raise TypeError(f'{type(value).__name__} is not cached')
+
+
+def _decode(value):
+    if '__datetime__' in value:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def resource_ids(value, key=''):
+    """Collects the strings under id keys anywhere in a request or response."""
+    ids = set()
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k not in NOT_RESOURCE_KEYS:
+                ids |= resource_ids(v, k)
+    elif isinstance(value, list):
+        for v in value:
+            ids |= resource_ids(v, key)
+    elif isinstance(value, str) and key.endswith(ID_SUFFIXES):
+        ids.add(value)
+    return ids
+
+
+class _CachedHttpResponse:
+    status_code = 200
+    headers = {}
+    content = b''
+
+
+class DescribeCache:
+    """
+    Serves read-only calls from a SQLite file through botocore's
+    before-parameter-build, before-call and after-call events.
+
+    A cached response is only served until this process makes its first
+    mutating call, so a workflow that waits for its own changes always
+    sees the live state; its reads still refresh the cache for later runs.
+    Listings without resource ids in their parameters are dropped by every
+    mutating call to the same service, as any change can show up in them.
+    """
+
+    def __init__(self, path, ttls=None):
+        self.ttls = dict(TTLS, **(ttls or {}))
+        self.serving = True
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._accounts = {}
+        import sqlite3
+
+        # responses are kept as json, a shared file must not be able to run code when read
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(SCHEMA)
+
+    def attach(self, client):
+        def before_parameter_build(params, context, **kwargs):
+            # the later events only get the request context, so it carries both
+            context['describe_cache_client'] = client
+            context['describe_cache_params'] = dict(params)
+
+        client.meta.events.register('before-parameter-build', before_parameter_build)
+        client.meta.events.register('before-call', self._before_call)
+        client.meta.events.register('after-call', self._after_call)
+
+    def _ttl(self, operation):
+        return self.ttls.get(operation, DEFAULT_TTL)
+
+    def _account(self, client):
+        # the account is looked up once per access key and kept in the file;
+        # botocore has no public accessor for a client's credentials
+        credentials = client._get_credentials()
+        if credentials is None:
+            return 'anonymous'
+        frozen = credentials.get_frozen_credentials()
+        if frozen.access_key in self._accounts:
+            return self._accounts[frozen.access_key]
+        with self._lock:
+            row = self._db.execute('SELECT account FROM accounts WHERE access_key = ?',
+                                   (frozen.access_key,)).fetchone()
+        if row:
+            account = row[0]
+        else:
+            import boto3
+
+            sts = boto3.client('sts', region_name=client.meta.region_name,
+                               aws_access_key_id=frozen.access_key,
+                               aws_secret_access_key=frozen.secret_key,
+                               aws_session_token=frozen.token)
+            account = sts.get_caller_identity()['Account']
+            with self._lock:
+                self._db.execute('INSERT OR REPLACE INTO accounts VALUES (?, ?)',
+                                 (frozen.access_key, account))
+        self._accounts[frozen.access_key] = account
+        return account
+
+    def _key(self, event_name, context):
+        _, service, operation = event_name.split('.')
+        client = context['describe_cache_client']
+        params = json.dumps(context['describe_cache_params'], sort_keys=True, default=str)
+        return self._account(client), client.meta.region_name, service, operation, params
+
+    def _cacheable(self, event_name):
+        _, service, operation = event_name.split('.')
+        return action_category(service, operation) == 'non-mutating' and self._ttl(operation) > 0
+
+    def _before_call(self, event_name, context, **kwargs):
+        if not self.serving or getattr(_live, 'depth', 0) or not self._cacheable(event_name):
+            return None
+        key = self._key(event_name, context)
+        with self._lock:
+            row = self._db.execute(
+                'SELECT response FROM responses WHERE account = ? AND region = ? AND service = ? '
+                'AND operation = ? AND params = ? AND expires > ?',
+                key + (time.time(),)).fetchone()
+            try:
+                response = json.loads(row[0], object_hook=_decode) if row else None
+            except ValueError:
+                # written by an older version of the cache
+                response = None
+            if response is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        context['describe_cache_hit'] = True
+        response['ResponseMetadata'] = {'HTTPStatusCode': 200, 'HTTPHeaders': {}, 'RetryAttempts': 0}
+        return _CachedHttpResponse(), response
+
+    def _after_call(self, event_name, http_response, parsed, context, **kwargs):
+        if context.get('describe_cache_hit'):
+            return
+        _, service, operation = event_name.split('.')
+        params = context.get('describe_cache_params', {})
+        if action_category(service, operation) != 'non-mutating':
+            self.serving = False
+            self.invalidate(context, service, resource_ids(params) | resource_ids(parsed))
+            return
+        if http_response.status_code >= 300 or not self._cacheable(event_name):
+            return
+
+        scoped = bool(resource_ids(params))
+        resources = '|' + '|'.join(sorted(resource_ids(params) | resource_ids(parsed))) + '|'
+        response = dict(parsed)
+        response.pop('ResponseMetadata', None)
+        try:
+            response = json.dumps(response, default=_encode)
+        except TypeError:
+            return
+        key = self._key(event_name, context)
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                key + (int(scoped), resources, time.time() + self._ttl(operation), response))
+
+    def invalidate(self, context, service, ids):
+        """Drops the listings of service and every entry that mentions one of ids."""
+        client = context['describe_cache_client']
+        clauses = ' OR '.join(['scoped = 0'] + ['instr(resources, ?) > 0'] * len(ids))
+        args = [self._account(client), client.meta.region_name, service] + [f'|{i}|' for i in ids]
+        with self._lock:
+            self._db.execute(
+                f'DELETE FROM responses WHERE account = ? AND region = ? AND service = ? AND ({clauses})',
+                args)
+
+
+_cache = None
+
+
+def enable(path, ttls=None):
+    """
+    Serves the read-only calls of every client from get_client() from the cache at path.
+
+    Returns:
+        DescribeCache: The cache, also kept for the rest of the process.
+    """
+    global _cache
+    from common.aws_clients import register_client_hook
+
+    if _cache is None:
+        _cache = DescribeCache(path, ttls)
+        register_client_hook(_cache.attach)
+    return _cache
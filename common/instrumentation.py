@@ -0,0 +1,176 @@
+'''
+: Opt-in API call metrics for every client created by get_client()
+: Enabled by setting AWS_API_METRICS_DIR, written there at exit as
+: api_metrics_<script>.json and api_metrics_<script>.prom
+
+'''
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import defaultdict
+
+# upper bounds in seconds of the latency histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException',
+                  'RequestLimitExceeded', 'RequestThrottled', 'RequestThrottledException',
+                  'TooManyRequestsException', 'SlowDown'}
+
+# label of the run, set by cli.py to the module of the command it runs
+script_name = None
+
+
+class _OperationMetrics:
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttles = 0
+        self.seconds = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+
+class ApiMetrics:
+    """
+    Collects call counts, latency histograms, retries and throttles per
+    service and operation from botocore's before-call, after-call and
+    needs-retry events.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = defaultdict(_OperationMetrics)
+
+    def attach(self, client):
+        client.meta.events.register('before-call', self._before_call)
+        client.meta.events.register('after-call', self._after_call)
+        client.meta.events.register('after-call-error', self._after_call_error)
+        client.meta.events.register('needs-retry', self._needs_retry)
+
+    def _key(self, event_name):
+        _, service, operation = event_name.split('.')
+        return service, operation
+
+    def _before_call(self, event_name, context, **kwargs):
+        context['metrics_started'] = time.monotonic()
+
+    def _record(self, event_name, context, error, retries):
+        started = context.get('metrics_started')
+        seconds = time.monotonic() - started if started else 0.0
+        with self._lock:
+            metrics = self._operations[self._key(event_name)]
+            metrics.calls += 1
+            metrics.errors += error
+            metrics.retries += retries
+            metrics.seconds += seconds
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    metrics.buckets[i] += 1
+
+    def _after_call(self, event_name, parsed, context, **kwargs):
+        # botocore fires after-call for responses served by the describe cache too
+        if context.get('describe_cache_hit'):
+            return
+        retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._record(event_name, context, 'Error' in parsed, retries)
+
+    def _after_call_error(self, event_name, context, exception=None, **kwargs):
+        response = getattr(exception, 'response', None) or {}
+        retries = response.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+        self._record(event_name, context, True, retries)
+
+    def _needs_retry(self, event_name, response=None, **kwargs):
+        # called once per attempt, before the retry handler decides
+        if response is None:
+            return None
+        code = response[1].get('Error', {}).get('Code', '')
+        if code in THROTTLE_CODES:
+            with self._lock:
+                self._operations[self._key(event_name)].throttles += 1
+        return None
+
+    def summary(self):
+        """
+        Returns:
+            dict: 'service.operation' -> counts, total seconds and latency buckets.
+        """
+        with self._lock:
+            return {
+                f'{service}.{operation}': {
+                    'calls': m.calls, 'errors': m.errors, 'retries': m.retries,
+                    'throttles': m.throttles, 'seconds': round(m.seconds, 3),
+                    'latency_buckets': dict(zip([str(b) for b in BUCKETS], m.buckets)),
+                }
+                for (service, operation), m in sorted(self._operations.items())
+            }
+
+    def prometheus(self, script):
+        """
+        Returns:
+            str: The metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        counters = [('aws_api_calls_total', 'calls', 'API calls made'),
+                    ('aws_api_errors_total', 'errors', 'API calls that returned an error'),
+                    ('aws_api_retries_total', 'retries', 'retried attempts'),
+                    ('aws_api_throttles_total', 'throttles', 'attempts rejected by throttling')]
+        with self._lock:
+            operations = sorted(self._operations.items())
+            for name, field, help_text in counters:
+                lines.append(f'# HELP {name} {help_text}')
+                lines.append(f'# TYPE {name} counter')
+                for (service, operation), m in operations:
+                    labels = f'script="{script}",service="{service}",operation="{operation}"'
+                    lines.append(f'{name}{{{labels}}} {getattr(m, field)}')
+
+            name = 'aws_api_call_duration_seconds'
+            lines.append(f'# HELP {name} API call latency including retries')
+            lines.append(f'# TYPE {name} histogram')
+            for (service, operation), m in operations:
+                labels = f'script="{script}",service="{service}",operation="{operation}"'
+                for bound, count in zip(BUCKETS, m.buckets):
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {m.calls}')
+                lines.append(f'{name}_sum{{{labels}}} {m.seconds:.6f}')
+                lines.append(f'{name}_count{{{labels}}} {m.calls}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, output_dir, script):
+        """
+        Writes the json summary and the Prometheus textfile, each replaced atomically.
+
+        Returns:
+            None
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        outputs = {f'api_metrics_{script}.json': json.dumps(self.summary(), indent=2),
+                   f'api_metrics_{script}.prom': self.prometheus(script)}
+        for file_name, content in outputs.items():
+            path = os.path.join(output_dir, file_name)
+            with open(path + '.tmp', 'w') as output_file:
+                output_file.write(content)
+            os.replace(path + '.tmp', path)
+
+
+def enable(output_dir, script=None):
+    """
+    Instruments every client of this run and writes the metrics at exit.
+
+    Args:
+        output_dir (str): Directory of the json summary and the Prometheus textfile.
+        script (str): Label of the run, defaults to the name of the running script.
+
+    Returns:
+        ApiMetrics: The collector.
+    """
+    from common.aws_clients import register_client_hook
+
+    script = script or script_name or os.path.splitext(os.path.basename(sys.argv[0]))[0] or 'python'
+    metrics = ApiMetrics()
+    register_client_hook(metrics.attach)
+    atexit.register(metrics.write, output_dir, script)
+    return metrics
@@ -0,0 +1,66 @@
+import logging
+import random
+import time
+
+from common.describe_cache import live
+
+logger = logging.getLogger(__name__)
+
+
+class PollTimeoutError(Exception):
+    """Raised when the polled resource does not reach its target state in time."""
+
+
+class PollFailedError(Exception):
+    """Raised when the polled resource enters a state it cannot recover from."""
+
+
+def poll(fetch, is_done, is_failed=None, description='resource', timeout=3600,
+         delay=2, max_delay=30, backoff=2, status=None):
+    """
+    Calls fetch() until is_done(result), sleeping with exponential backoff and jitter.
+
+    The first sleeps are short so a quick state transition is noticed within
+    seconds, and they grow to max_delay so a long one costs few API calls.
+    The calls fetch makes are never served from the describe cache.
+
+    Args:
+        fetch (callable): Returns the current state of the resource.
+        is_done (callable): Returns True when the state is the target one.
+        is_failed (callable): Returns True when the state is a terminal error.
+        description (str): What is being waited for, used in log messages.
+        timeout (int): Seconds to wait before giving up.
+        delay (float): The first sleep in seconds.
+        max_delay (float): The largest sleep in seconds.
+        backoff (float): The factor the sleep grows by after every attempt.
+        status (callable): Turns the result into a short text for log messages.
+
+    Returns:
+        The last result of fetch().
+
+    Raises:
+        PollFailedError: If is_failed(result) is True.
+        PollTimeoutError: If the timeout expires first.
+    """
+    deadline = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        with live():
+            result = fetch()
+        current = status(result) if status else result
+        if is_done(result):
+            return result
+        if is_failed and is_failed(result):
+            raise PollFailedError(f"{description} failed (current status: {current})")
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise PollTimeoutError(
+                f"Timed out after {timeout}s waiting for {description} (current status: {current})")
+
+        sleep = min(max_delay, delay * backoff ** attempt)
+        sleep = min(remaining, random.uniform(sleep / 2, sleep))
+        logger.info(
+            f"Waiting for {description} (current status: {current}), next check in {sleep:.1f}s...")
+        time.sleep(sleep)
+        attempt += 1
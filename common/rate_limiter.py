@@ -0,0 +1,147 @@
+'''
+: Client-side token buckets, one per API action, shared by all worker threads
+: The refill rate halves on throttling errors, at most once per refill
+: interval so a burst of them counts once, and recovers slowly on every
+: successful call, up to the configured rate
+
+'''
+import threading
+import time
+
+from common.instrumentation import THROTTLE_CODES
+
+# (bucket size, refill per second), after the EC2 API request throttling limits
+LIMITS = {
+    'non-mutating': (100, 20),
+    'mutating': (200, 5),
+    'resource-intensive': (50, 5),
+}
+
+RESOURCE_INTENSIVE = {'AttachVolume', 'CreateSnapshot', 'CreateSnapshots', 'CreateVolume',
+                      'DeleteVolume', 'DetachVolume', 'RunInstances', 'CopySnapshot'}
+
+MIN_RATE = 0.2
+
+# share of the configured rate given back after each successful call
+RECOVERY = 0.02
+
+
+def action_category(service, operation):
+    if service == 'ec2' and operation in RESOURCE_INTENSIVE:
+        return 'resource-intensive'
+    if operation.startswith(('Describe', 'List', 'Get')):
+        return 'non-mutating'
+    return 'mutating'
+
+
+class TokenBucket:
+
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.max_rate = rate
+        self.rate = rate
+        self.tokens = capacity
+        self._updated = time.monotonic()
+        self._decreased = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            now = time.monotonic()
+            # the throttles of the calls already in flight answer the same overload
+            if self._decreased is not None and now - self._decreased < 1 / self.rate:
+                return
+            self._refill()
+            self.rate = max(MIN_RATE, self.rate / 2)
+            self._decreased = now
+
+    def succeeded(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill()
+                self.rate = min(self.max_rate, self.rate + self.max_rate * RECOVERY)
+
+
+class RateLimiter:
+    """
+    Holds one TokenBucket per (service, operation), sized by action category.
+
+    attach() makes every attempt of a client call take a token first, so
+    retries are limited too, and feeds throttling errors and successful
+    calls back into the bucket's rate.
+    """
+
+    def __init__(self, limits=LIMITS):
+        self.limits = limits
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, service, operation):
+        key = (service, operation)
+        with self._lock:
+            if key not in self._buckets:
+                capacity, rate = self.limits[action_category(service, operation)]
+                self._buckets[key] = TokenBucket(capacity, rate)
+            return self._buckets[key]
+
+    def _bucket_for(self, event_name):
+        _, service, operation = event_name.split('.')
+        return self.bucket(service, operation)
+
+    def _before_send(self, event_name, **kwargs):
+        self._bucket_for(event_name).acquire()
+
+    def _needs_retry(self, event_name, response=None, **kwargs):
+        if response is not None and response[1].get('Error', {}).get('Code') in THROTTLE_CODES:
+            self._bucket_for(event_name).throttled()
+        return None
+
+    def _after_call(self, event_name, parsed, context, **kwargs):
+        # a response served by the describe cache says nothing about AWS's limits
+        if context.get('describe_cache_hit'):
+            return
+        if 'Error' not in parsed:
+            self._bucket_for(event_name).succeeded()
+
+    def attach(self, client):
+        # first, so a token is taken before any other handler sends the request
+        client.meta.events.register_first('before-send', self._before_send)
+        client.meta.events.register('needs-retry', self._needs_retry)
+        client.meta.events.register('after-call', self._after_call)
+
+
+_limiter = None
+_limiter_lock = threading.Lock()
+
+
+def enable():
+    """
+    Rate limits every client from common.aws_clients.get_client() with one shared limiter.
+
+    Returns:
+        RateLimiter: The shared limiter, the same one on every call.
+    """
+    global _limiter
+    from common.aws_clients import register_client_hook
+
+    with _limiter_lock:
+        if _limiter is None:
+            _limiter = RateLimiter()
+            register_client_hook(_limiter.attach)
+        return _limiter
@@ -0,0 +1,219 @@
+'''
+: Small DAG workflow engine for the runbooks
+: A workflow is a set of steps with dependencies and retry policies; steps
+: run on an asyncio loop as soon as their dependencies are done, their
+: blocking boto3 calls on a thread pool
+
+'''
+import asyncio
+import functools
+import logging
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class RetryPolicy:
+    """
+    How often a failed step is run again and how long to wait in between.
+
+    Args:
+        attempts (int): Runs in total, 1 for no retries.
+        delay (float): Seconds before the first retry.
+        backoff (float): Factor the delay grows by after every retry.
+        max_delay (float): Upper bound of the delay.
+        retry_on (tuple): Exception types worth a retry, others fail the step at once.
+        retry_if (callable): Narrows retry_on down, called with the error and
+            True when it is worth a retry, e.g. for its error code.
+    """
+
+    def __init__(self, attempts=1, delay=5, backoff=2, max_delay=60, retry_on=(Exception,),
+                 retry_if=None):
+        self.attempts = attempts
+        self.delay = delay
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.retry_if = retry_if
+
+    def delays(self):
+        """Yields the seconds to wait before each retry, with jitter."""
+        delay = self.delay
+        for _ in range(self.attempts - 1):
+            yield random.uniform(delay / 2, delay)
+            delay = min(delay * self.backoff, self.max_delay)
+
+
+NO_RETRY = RetryPolicy()
+
+
+class Step:
+    """
+    One node of a workflow.
+
+    Args:
+        name (str): Unique within the workflow.
+        action (callable): Blocking function called with the dict of the
+            results of the steps done so far; its return value is this step's result.
+        after (iterable): Names of the steps that have to finish first.
+        retry (RetryPolicy): What to do when action raises.
+    """
+
+    def __init__(self, name, action, after=(), retry=NO_RETRY):
+        self.name = name
+        self.action = action
+        self.after = tuple(after)
+        self.retry = retry
+
+
+class WorkflowError(Exception):
+
+    def __init__(self, workflow, step, error):
+        super().__init__(f"{workflow}: step '{step}' failed: {error}")
+        self.workflow = workflow
+        self.step = step
+        self.error = error
+
+
+class _Skipped(Exception):
+    pass
+
+
+class WorkflowRun:
+    """The outcome of one workflow: step results, error and wall clock."""
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.results = {}
+        self.error = None
+        self.seconds = 0.0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class Workflow:
+    """
+    A named DAG of steps.
+
+    Independent steps run at the same time. When a step fails for good the
+    steps depending on it are skipped, the steps already running are let
+    finish, and the workflow fails with the first error.
+    """
+
+    def __init__(self, name, steps):
+        self.name = name
+        self.steps = {}
+        for step in steps:
+            if step.name in self.steps:
+                raise ValueError(f"{name}: duplicate step '{step.name}'")
+            self.steps[step.name] = step
+        for step in self.steps.values():
+            unknown = set(step.after) - set(self.steps)
+            if unknown:
+                raise ValueError(f"{name}: step '{step.name}' depends on unknown steps {sorted(unknown)}")
+        self.order = self._topological_order()
+
+    def _topological_order(self):
+        waiting = {name: set(step.after) for name, step in self.steps.items()}
+        order = []
+        while waiting:
+            ready = [name for name, after in waiting.items() if not after]
+            if not ready:
+                raise ValueError(f'{self.name}: steps {sorted(waiting)} depend on each other')
+            for name in ready:
+                del waiting[name]
+                order.append(name)
+            for after in waiting.values():
+                after.difference_update(ready)
+        return order
+
+    async def _run_step(self, step, tasks, run, executor):
+        for name in step.after:
+            try:
+                await tasks[name]
+            except Exception:
+                raise _Skipped()
+
+        loop = asyncio.get_running_loop()
+        delays = step.retry.delays()
+        while True:
+            try:
+                result = await loop.run_in_executor(
+                    executor, functools.partial(step.action, run.results))
+                run.results[step.name] = result
+                return result
+            except step.retry.retry_on as e:
+                if step.retry.retry_if and not step.retry.retry_if(e):
+                    raise
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                logger.info(f"{self.name}: step '{step.name}' failed ({e}), retrying in {delay:.0f}s")
+                await asyncio.sleep(delay)
+
+    async def run_async(self, executor=None):
+        """
+        Runs the workflow on the running loop, blocking steps on executor.
+
+        Returns:
+            WorkflowRun: Never raises for a failed step, see its error.
+        """
+        run = WorkflowRun(self)
+        started = time.monotonic()
+        tasks = {}
+        for name in self.order:
+            tasks[name] = asyncio.ensure_future(self._run_step(self.steps[name], tasks, run, executor))
+        outcomes = await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for name, outcome in zip(tasks, outcomes):
+            if isinstance(outcome, BaseException) and not isinstance(outcome, _Skipped):
+                run.error = WorkflowError(self.name, name, outcome)
+                break
+        run.seconds = time.monotonic() - started
+        return run
+
+    def run(self, executor=None):
+        """
+        Runs the workflow to the end from blocking code.
+
+        Returns:
+            dict: Step name -> result.
+
+        Raises:
+            WorkflowError: For the first step that failed.
+        """
+        run = asyncio.run(self.run_async(executor))
+        if run.error:
+            raise run.error
+        return run.results
+
+
+def run_all(workflows, max_concurrency=10, max_threads=None):
+    """
+    Runs many workflows on one loop, at most max_concurrency at a time.
+
+    Args:
+        workflows (iterable): The workflows to run.
+        max_concurrency (int): Workflows in flight at the same time.
+        max_threads (int): Size of the thread pool for the blocking steps,
+            by default enough for every workflow in flight to run 4 steps.
+
+    Returns:
+        list: One WorkflowRun per workflow, in the same order.
+    """
+    workflows = list(workflows)
+
+    async def run_workflows(executor):
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def run_one(workflow):
+            async with semaphore:
+                return await workflow.run_async(executor)
+
+        return await asyncio.gather(*(run_one(workflow) for workflow in workflows))
+
+    with ThreadPoolExecutor(max_workers=max_threads or 4 * max_concurrency) as executor:
+        return asyncio.run(run_workflows(executor))
@@ -0,0 +1,160 @@
+import logging
+import threading
+import time
+
+from common.describe_cache import live
+
+logger = logging.getLogger(__name__)
+
+# kind -> (describe call, id filter, result key, id key)
+DESCRIBE = {
+    'instance': ('describe_instances', 'instance-id', 'Reservations', 'InstanceId'),
+    'volume': ('describe_volumes', 'volume-id', 'Volumes', 'VolumeId'),
+    'snapshot': ('describe_snapshots', 'snapshot-id', 'Snapshots', 'SnapshotId'),
+}
+
+# states that mean the target state will never be reached
+FAILURE_STATES = {
+    ('instance', 'running'): {'shutting-down', 'terminated', 'stopping'},
+    ('instance', 'stopped'): {'terminated'},
+    ('volume', 'available'): {'deleted', 'error'},
+    ('volume', 'in-use'): {'deleted', 'error'},
+    ('snapshot', 'completed'): {'error'},
+}
+
+# EC2 accepts at most 200 values per filter
+MAX_IDS = 200
+
+
+def resource_state(kind, resource):
+    if kind == 'instance':
+        return resource['State']['Name']
+    return resource['State']
+
+
+class _Request:
+
+    def __init__(self, target, deadline):
+        self.target = target
+        self.deadline = deadline
+        self.event = threading.Event()
+        self.resource = None
+        self.error = None
+
+
+class BatchWaiter:
+    """
+    Shared replacement for the per-resource boto3 EC2 waiters.
+
+    Every thread that calls wait() registers its id with one poller thread.
+    Each tick the poller makes one describe call per kind for up to MAX_IDS
+    pending ids and wakes the callers whose resource reached its target, so
+    the number of describe calls no longer grows with the number of workers.
+    """
+
+    def __init__(self, client, delay=15):
+        self.client = client
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._pending = {kind: {} for kind in DESCRIBE}
+        self._thread = None
+
+    def wait(self, kind, resource_id, target, timeout=600):
+        """
+        Blocks until the resource reaches the target state.
+
+        Args:
+            kind (str): 'instance', 'volume' or 'snapshot'.
+            resource_id (str): The id of the resource to wait for.
+            target (str): The state to wait for, e.g. 'stopped' or 'completed'.
+            timeout (int): Seconds to wait before giving up.
+
+        Returns:
+            dict: The last description of the resource.
+
+        Raises:
+            WaiterError: If the resource reaches a failure state or the timeout expires.
+        """
+        request = _Request(target, time.monotonic() + timeout)
+        with self._lock:
+            self._pending[kind].setdefault(resource_id, []).append(request)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+        request.event.wait()
+        if request.error:
+            from botocore.exceptions import WaiterError
+
+            raise WaiterError(name=f'{kind}_{target}', reason=request.error,
+                              last_response=request.resource)
+        return request.resource
+
+    def _run(self):
+        while True:
+            with self._lock:
+                pending = {kind: list(ids) for kind, ids in self._pending.items() if ids}
+                if not pending:
+                    self._thread = None
+                    return
+
+            for kind, ids in pending.items():
+                for i in range(0, len(ids), MAX_IDS):
+                    chunk = ids[i:i + MAX_IDS]
+                    try:
+                        with live():
+                            found = self._describe(kind, chunk)
+                    except Exception as e:
+                        logger.warning(f"Polling {kind}s failed, retrying next tick: {e}")
+                        continue
+                    self._resolve(kind, found)
+
+            self._expire()
+            time.sleep(self.delay)
+
+    def _describe(self, kind, ids):
+        operation, id_filter, result_key, id_key = DESCRIBE[kind]
+        found = {}
+        params = {'Filters': [{'Name': id_filter, 'Values': ids}]}
+        if kind == 'snapshot':
+            # every snapshot waited on is our own, without this each tick also searches the public ones
+            params['OwnerIds'] = ['self']
+        paginator = self.client.get_paginator(operation)
+        for page in paginator.paginate(**params):
+            resources = page[result_key]
+            if kind == 'instance':
+                resources = [j for i in resources for j in i['Instances']]
+            for resource in resources:
+                found[resource[id_key]] = resource
+        return found
+
+    def _resolve(self, kind, found):
+        with self._lock:
+            for resource_id, resource in found.items():
+                requests = self._pending[kind].get(resource_id, [])
+                state = resource_state(kind, resource)
+                for request in list(requests):
+                    request.resource = resource
+                    if state == request.target:
+                        pass
+                    elif state in FAILURE_STATES.get((kind, request.target), ()):
+                        request.error = f'{kind} {resource_id} entered state {state}'
+                    else:
+                        continue
+                    requests.remove(request)
+                    request.event.set()
+                if not requests:
+                    self._pending[kind].pop(resource_id, None)
+
+    def _expire(self):
+        now = time.monotonic()
+        with self._lock:
+            for kind, ids in self._pending.items():
+                for resource_id, requests in list(ids.items()):
+                    for request in list(requests):
+                        if now >= request.deadline:
+                            request.error = f'timed out waiting for {kind} {resource_id} to be {request.target}'
+                            requests.remove(request)
+                            request.event.set()
+                    if not requests:
+                        del ids[resource_id]
@@ -8,35 +8,57 @@
 : Start instance back
 
 '''
+import argparse
 import csv
-import boto3
-import pandas as pd
+import itertools
+import os
+import queue
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import rate_limiter
+from common.aws_clients import lazy_client
+from common.instrumentation import THROTTLE_CODES
+from common.workflow import RetryPolicy, Step, Workflow
+from ec2 import get_instance_details
+from ec2.batch_waiter import BatchWaiter
+from ec2.journal import Journal, load_journal
+from ec2 import planner
+
 t = datetime.now()
 d1 = t.strftime("%b-%d-%Y")
 t1 = t.strftime('%H-%M-%S')
 
 
-client = boto3.client('ec2')
-ec2 = boto3.resource('ec2')
+client = lazy_client('ec2')
+waiter = BatchWaiter(client)
+
+# errors that go away by trying again a little later; a failed or timed out wait does not
+TRANSIENT_CODES = THROTTLE_CODES | {'IncorrectState', 'IncorrectInstanceState',
+                                    'SnapshotCreationPerVolumeRateExceeded',
+                                    'ConcurrentSnapshotLimitExceeded'}
+
+
+def is_transient(error):
+    return error.response.get('Error', {}).get('Code') in TRANSIENT_CODES
 
 
 def stop_instance(instance_id):
     print(f'Stopping instance {instance_id}...')
-    client = boto3.client('ec2')
     client.stop_instances(InstanceIds=[instance_id])
-    client.get_waiter('instance_stopped').wait(InstanceIds=[instance_id])
+    waiter.wait('instance', instance_id, 'stopped')
     print(f'*** Instance {instance_id} has been stopped')
 
 # stop_instance()
 
 
-def create_snapshot(volume_id):
+def create_snapshot(volume_id, name='snap-unencr'):
     print(f'Taking snapshot for volume id: {volume_id} ...')
-    volume = ec2.Volume(volume_id)
-
-    snapshot = volume.create_snapshot(
+    snapshot = client.create_snapshot(
+        VolumeId=volume_id,
         Description=f'Snapshot taken for {volume_id} before encryption',
         TagSpecifications=[
             {
@@ -48,29 +70,28 @@ def create_snapshot(volume_id):
                     },
                     {
                         'Key': 'Name',
-                        'Value': f'snap-unencr'
+                        'Value': name
                     }
                 ]
             }
         ]
     )
-    # print(snapshot)
-    # print(snapshot.id)
+    snapshot_id = snapshot['SnapshotId']
+    print(f'Snapshot {snapshot_id} started for {volume_id}')
 
-    client.get_waiter('snapshot_completed').wait(SnapshotIds=[snapshot.id], WaiterConfig={
-        'Delay': 20,
-        'MaxAttempts': 100
-    })
-    print(f'*** Snapshot taken for {volume_id}, snapshotId: {snapshot.id}')
+    return (snapshot_id)
 
-    return (snapshot)
 
+def wait_for_snapshot(snapshot_id):
+    waiter.wait('snapshot', snapshot_id, 'completed', timeout=2000)
+    print(f'*** Snapshot {snapshot_id} completed')
 
-def detach_root_vol(volume_id, instance_id):
+
+def detach_volume(volume_id, instance_id, device='/dev/xvda'):
     print(f'Detaching volume {volume_id} from {instance_id}...')
-    volume = ec2.Volume(volume_id)
-    response = volume.detach_from_instance(
-        Device='/dev/xvda',
+    response = client.detach_volume(
+        VolumeId=volume_id,
+        Device=device,
         Force=True,
         InstanceId=instance_id,
         DryRun=False
@@ -78,13 +99,24 @@ def detach_root_vol(volume_id, instance_id):
     print(f'Volume {volume_id} detached from {instance_id}')
 
 
-def create_volume(snapshot_id, AZ):
-    print(f'Creating new volume from {snapshot_id} in {AZ}...')
+# volume types that take provisioned iops / throughput
+IOPS_TYPES = {'io1', 'io2', 'gp3'}
+THROUGHPUT_TYPES = {'gp3'}
+
+
+def create_volume(snapshot_id, AZ, volume_type='gp2', iops=None, throughput=None):
+    print(f'Creating new {volume_type} volume from {snapshot_id} in {AZ}...')
+    performance = {}
+    if iops and volume_type in IOPS_TYPES:
+        performance['Iops'] = int(iops)
+    if throughput and volume_type in THROUGHPUT_TYPES:
+        performance['Throughput'] = int(throughput)
     response = client.create_volume(
         AvailabilityZone=AZ,
         Encrypted=True,
         SnapshotId=snapshot_id,
-        VolumeType='gp2',
+        VolumeType=volume_type,
+        **performance,
         TagSpecifications=[
             {
                 'ResourceType': 'volume',
@@ -106,28 +138,24 @@ def create_volume(snapshot_id, AZ):
         new_volume_id = response['VolumeId']
         print('New volume id: ', new_volume_id)
 
-        client.get_waiter('volume_available').wait(
-            VolumeIds=[new_volume_id],
+        return (new_volume_id)
 
-        )
-        print('***Success!! volume:', new_volume_id, 'created...')
 
-        return (new_volume_id)
+def wait_for_volume(new_volume_id):
+    waiter.wait('volume', new_volume_id, 'available')
+    print('***Success!! volume:', new_volume_id, 'created...')
 
 
-def attach_volume(instance_id, new_volume_id):
-    print(f'Attaching new volume {new_volume_id} to {instance_id}...')
+def attach_volume(instance_id, new_volume_id, device='/dev/xvda'):
+    print(f'Attaching new volume {new_volume_id} to {instance_id} as {device}...')
     response = client.attach_volume(
-        Device='/dev/xvda',
+        Device=device,
         InstanceId=instance_id,
         VolumeId=new_volume_id
     )
 
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-        client.get_waiter('volume_in_use').wait(
-            VolumeIds=[new_volume_id],
-            DryRun=False
-        )
+        waiter.wait('volume', new_volume_id, 'in-use')
         print('***Success!! volume:', new_volume_id,
               'is attached to instance:', instance_id)
 
@@ -140,44 +168,371 @@ def start_instance(instance_id):
         ]
     )
     if response['ResponseMetadata']['HTTPStatusCode'] == 200:
-        client.get_waiter('instance_running').wait(
-            InstanceIds=[instance_id],
-            DryRun=False
-        )
+        waiter.wait('instance', instance_id, 'running')
         print(
-            f'***Success!! Instance {instance_id} is running with new encrypted volume')
-
-
-df = pd.read_csv('input.csv')
-
-data = []
-columns = ['instance_id', 'root_volume_id', 'size',
-           'AvailabilityZone', 'new_volume_id', 'snapshot_id']
+            f'***Success!! Instance {instance_id} is running with new encrypted volumes')
+
+
+columns = ['instance_id', 'volume_id', 'device', 'size',
+           'AvailabilityZone', 'new_volume_id', 'snapshot_id', 'status']
+
+
+def group_instances(rows):
+    """
+    Turns the one-row-per-volume input into one job per instance.
+
+    Returns:
+        list: dicts with instance_id, AvailabilityZone, instance_state and
+        volumes, a list of dicts with volume_id, device, size, volume_type,
+        iops and throughput.
+    """
+    jobs = {}
+    for row in rows:
+        job = jobs.setdefault(row['instance_id'], {
+            'instance_id': row['instance_id'],
+            'AvailabilityZone': row['AvailabilityZone'],
+            'instance_state': row['instance_state'],
+            'volumes': [],
+        })
+        job['volumes'].append({'volume_id': row['volume_id'], 'device': row['device'],
+                               'size': int(row['size']),
+                               # csv files from before these columns were written only had gp2 volumes
+                               'volume_type': row.get('volume_type') or 'gp2',
+                               'iops': row.get('iops'), 'throughput': row.get('throughput')})
+    return list(jobs.values())
+
+
+def read_jobs(path):
+    """Reads the instance jobs from a csv written by get_instance_details.py."""
+    import pandas as pd
+
+    df = pd.read_csv(path)
+    # csv files from before per-device discovery only list the root volume
+    df = df.rename(columns={'root_volume_id': 'volume_id'})
+    if 'device' not in df:
+        df['device'] = '/dev/xvda'
+    # empty iops / throughput cells are read as NaN
+    df = df.astype(object).where(df.notna(), None)
+    return group_instances(df.to_dict('records'))
+
+
+def resume_jobs(resume_state):
+    """
+    Rebuilds the jobs of the instances a journal left unfinished from their begin records.
+
+    A crashed run can leave an instance stopped with its old volumes
+    detached; discovery no longer lists it, but its begin record still
+    holds the volumes, AZ and state it had before it was touched.
+    """
+    jobs = []
+    for instance_id, state in resume_state.items():
+        if 'begin' in state and 'done' not in state:
+            begin = state['begin']
+            jobs.append({'instance_id': instance_id, 'AvailabilityZone': begin['availability_zone'],
+                         'instance_state': begin['instance_state'], 'volumes': begin['volumes']})
+    return jobs
+
+
+def discover_jobs():
+    """Yields instance jobs while get_instance_details.py is still paging."""
+    for rows in get_instance_details.iter_instance_pages():
+        yield from group_instances(dict(zip(get_instance_details.columns, row)) for row in rows)
+
+
+def instance_workflow(job, journal, state, prewarm=False):
+    """
+    Declares the encryption of one instance as a workflow.
+
+    Once the instance is stopped every volume goes through its own branch,
+    snapshot -> (detach, new volume) -> attach, side by side with the other
+    volumes, and the instance is started when all of them are attached.
+    The snapshots are taken while the instance is stopped, so they are
+    consistent with each other.
+
+    Every finished step is written to the journal and to state, so a step
+    that is retried, or replayed with --resume, skips what it already did:
+    a snapshot or volume that was started but not finished is waited on,
+    not recreated.
+
+    Returns:
+        common.workflow.Workflow: Step results are the new snapshot and volume ids.
+    """
+    instance_id = job['instance_id']
+    availability_zone = job['AvailabilityZone']
+    running = job['instance_state'] == 'running'
+    from botocore.exceptions import ClientError
+
+    retry = RetryPolicy(attempts=3, delay=15, retry_on=(ClientError,), retry_if=is_transient)
+
+    def record(step, **fields):
+        journal.record(instance_id, step, **fields)
+        state[step] = fields
+
+    def once(step, action):
+        def run(results):
+            if step not in state:
+                action()
+                record(step)
+        return run
+
+    def create_and_wait(started_step, completed_step, id_field, create, wait_for):
+        def run(results):
+            if started_step in state:
+                resource_id = state[started_step][id_field]
+            else:
+                resource_id = create(results)
+                record(started_step, **{id_field: resource_id})
+            if completed_step not in state:
+                wait_for(resource_id)
+                record(completed_step, **{id_field: resource_id})
+            return resource_id
+        return run
+
+    def volume_steps(volume):
+        volume_id = volume['volume_id']
+        device = volume['device']
+
+        def attach(results):
+            if f'attached:{volume_id}' not in state:
+                # the device is free once the old volume is detached
+                waiter.wait('volume', volume_id, 'available')
+                attach_volume(instance_id, results[f'volume:{volume_id}'], device)
+                record(f'attached:{volume_id}', new_volume_id=results[f'volume:{volume_id}'])
+
+        return [
+            Step(f'snapshot:{volume_id}',
+                 create_and_wait(f'snapshot_started:{volume_id}', f'snapshot_completed:{volume_id}',
+                                 'snapshot_id', lambda results: create_snapshot(volume_id),
+                                 wait_for_snapshot),
+                 after=['stop'], retry=retry),
+            Step(f'detach:{volume_id}',
+                 once(f'detached:{volume_id}', lambda: detach_volume(volume_id, instance_id, device)),
+                 after=[f'snapshot:{volume_id}'], retry=retry),
+            Step(f'volume:{volume_id}',
+                 create_and_wait(f'volume_created:{volume_id}', f'volume_available:{volume_id}',
+                                 'new_volume_id',
+                                 lambda results: create_volume(results[f'snapshot:{volume_id}'],
+                                                               availability_zone, volume['volume_type'],
+                                                               volume['iops'], volume['throughput']),
+                                 wait_for_volume),
+                 after=[f'snapshot:{volume_id}'], retry=retry),
+            Step(f'attach:{volume_id}', attach,
+                 after=[f'detach:{volume_id}', f'volume:{volume_id}'], retry=retry),
+        ]
 
-for i, row in df.iterrows():
-    print(i)
-    instance_id = row['instance_id']
-    volume_id = row['root_volume_id']
-    availability_zone = row['AvailabilityZone']
-    instance_state = row['instance_state']
-    print(instance_id, volume_id, availability_zone)
+    def baseline_step(volume):
+        volume_id = volume['volume_id']
+        return Step(f'baseline:{volume_id}',
+                    create_and_wait(f'baseline_started:{volume_id}', f'baseline_completed:{volume_id}',
+                                    'snapshot_id',
+                                    lambda results: create_snapshot(volume_id, name='snap-unencr-baseline'),
+                                    wait_for_snapshot),
+                    retry=retry)
+
+    steps = []
+    if prewarm and running:
+        steps += [baseline_step(volume) for volume in job['volumes']]
+    steps.append(Step('stop', once('stopped', lambda: stop_instance(instance_id)),
+                      after=[step.name for step in steps], retry=retry))
+    for volume in job['volumes']:
+        steps += volume_steps(volume)
+    if running:
+        steps.append(Step('start', once('started', lambda: start_instance(instance_id)),
+                          after=[f'attach:{volume["volume_id"]}' for volume in job['volumes']],
+                          retry=retry))
+    return Workflow(instance_id, steps)
+
+
+def encrypt_instance(job, journal, state=None, prewarm=False):
+    """
+    Replaces every unencrypted volume of one instance in a single stop window.
+
+    Steps already present in state (replayed from the journal on --resume)
+    are skipped, see instance_workflow.
+
+    With prewarm a baseline snapshot of a running instance is taken before it
+    is stopped, so the snapshot taken while it is down is incremental and
+    only copies the blocks changed since the baseline.
+    """
+    instance_id = job['instance_id']
+    if state:
+        # the instance may already be stopped with its volumes detached, the
+        # journal knows what it looked like before it was touched
+        begin = state['begin']
+        job = dict(job, AvailabilityZone=begin['availability_zone'],
+                   instance_state=begin['instance_state'], volumes=begin['volumes'])
+        prewarm = begin.get('prewarm', False)
+    availability_zone = job['AvailabilityZone']
+    volumes = job['volumes']
+    print(instance_id, [volume['volume_id'] for volume in volumes], availability_zone)
+
+    if not state:
+        state = {}
+        journal.record(instance_id, 'begin', volumes=volumes,
+                       size=sum(volume['size'] for volume in volumes),
+                       availability_zone=availability_zone, instance_state=job['instance_state'],
+                       prewarm=prewarm)
 
     print(f'Starting operation for {instance_id}')
-    stop_instance(instance_id)
-    snapshot_id = create_snapshot(volume_id).id
-    detach_root_vol(volume_id, instance_id)
-    new_volume_id = create_volume(snapshot_id, availability_zone)
-    attach_volume(instance_id, new_volume_id)
-    if instance_state == 'running':
-        start_instance(instance_id)
+    results = instance_workflow(job, journal, state, prewarm).run()
     print(f'Operation successful for {instance_id}')
 
-    new_row = [instance_id, volume_id,
-               availability_zone, new_volume_id, snapshot_id]
-
-    data.append(new_row)
+    new_rows = [[instance_id, volume['volume_id'], volume['device'], volume['size'],
+                 availability_zone, results[f'volume:{volume["volume_id"]}'],
+                 results[f'snapshot:{volume["volume_id"]}'], 'success']
+                for volume in volumes]
+    journal.record(instance_id, 'done', rows=new_rows)
+
+    return new_rows
+
+
+def encrypt_fleet(jobs, journal, max_workers=1, max_per_az=None, resume_state=None, prewarm=False):
+    """
+    Runs encrypt_instance for every instance job on a bounded worker pool.
+
+    At most max_workers pipelines run at once and at most max_per_az of
+    them in the same AvailabilityZone. A failed instance is recorded in
+    the journal with its error and does not stop the rest of the fleet.
+    Instances that resume_state already marks as done are not touched.
+    The largest volumes are started first (LPT) to shorten the whole run.
+
+    jobs may also be a generator such as discover_jobs(); it is drained on
+    a background thread and every job is dispatched as soon as it arrives,
+    largest first among the ones waiting.
+    """
+    resume_state = resume_state or {}
+    data = []
+
+    discovered = queue.Queue()
+    discovery_errors = []
+
+    def discover():
+        try:
+            for job in jobs:
+                discovered.put(job)
+        except Exception as e:
+            discovery_errors.append(e)
+        finally:
+            discovered.put(None)
+
+    if isinstance(jobs, list):
+        discover()
+    else:
+        threading.Thread(target=discover, daemon=True).start()
+
+    # the same dispatch order as the --plan simulation
+    dispatcher = planner.Dispatcher(max_workers, max_per_az)
+
+    def accept(job):
+        state = resume_state.get(job['instance_id'], {})
+        if 'done' in state:
+            print(f'*** {job["instance_id"]} already encrypted, skipping')
+            data.extend(state['done']['rows'])
+            return
+        dispatcher.add(job)
+
+    lock = threading.Lock()
+
+    def run(job):
+        instance_id = job['instance_id']
+        try:
+            new_rows = encrypt_instance(job, journal, resume_state.get(instance_id), prewarm)
+        except Exception as e:
+            print(f'***ERROR*** Operation failed for {instance_id}: {e}')
+            journal.record(instance_id, 'failed', error=str(e))
+            new_rows = [[instance_id, volume['volume_id'], volume['device'], volume['size'],
+                         job['AvailabilityZone'], '', '', f'failed: {e}']
+                        for volume in job['volumes']]
+        with lock:
+            data.extend(new_rows)
+        return new_rows
+
+    futures = {}
+    discovering = True
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while discovering or dispatcher.pending or futures:
+            # take everything discovered so far, blocking only when there is nothing to run
+            while discovering:
+                try:
+                    job = discovered.get(block=not futures and not dispatcher.pending)
+                except queue.Empty:
+                    break
+                if job is None:
+                    discovering = False
+                else:
+                    accept(job)
+
+            for job in dispatcher.start():
+                futures[executor.submit(run, job)] = job
+            if not futures:
+                continue
+            # wake up now and then to dispatch instances discovered in the meantime
+            done, _ = wait(futures, timeout=1 if discovering else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                dispatcher.finished(futures.pop(future))
+
+    if discovery_errors:
+        raise discovery_errors[0]
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Replace unencrypted volumes with encrypted copies')
+    parser.add_argument('--input', default='input.csv',
+                        help='csv written by get_instance_details.py')
+    parser.add_argument('--discover', action='store_true',
+                        help='stream the instances found by get_instance_details.py straight into '
+                             'the workers instead of reading --input')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of instances processed at the same time')
+    parser.add_argument('--max-per-az', type=int, default=None,
+                        help='limit of instances processed at the same time in one AZ')
+    parser.add_argument('--journal', default='encrypt_ebs_journal.jsonl',
+                        help='append-only log of every finished step')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the steps already recorded in the journal')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='take a baseline snapshot before stopping, so the one taken while stopped is incremental')
+    parser.add_argument('--plan', action='store_true',
+                        help='only print the predicted schedule, makespan and downtime')
+    args = parser.parse_args()
+
+    resume_state = load_journal(args.journal) if args.resume else {}
+    # the unfinished instances come from the journal, not from discovery or --input
+    unfinished = resume_jobs(resume_state)
+    resumed = {job['instance_id'] for job in unfinished}
+    if args.discover:
+        jobs = itertools.chain(unfinished, (job for job in discover_jobs()
+                                            if job['instance_id'] not in resumed))
+    else:
+        jobs = unfinished + [job for job in read_jobs(args.input) if job['instance_id'] not in resumed]
+
+    if args.plan:
+        jobs = list(jobs)
+        model = planner.learn_model(args.journal)
+        schedule, makespan = planner.plan(jobs, model, args.workers, args.max_per_az, args.prewarm)
+        planner.print_plan(schedule, makespan)
+        return
+
+    rate_limiter.enable()
+
+    with Journal(args.journal) as journal:
+        data = encrypt_fleet(jobs, journal, max_workers=args.workers,
+                             max_per_az=args.max_per_az, resume_state=resume_state,
+                             prewarm=args.prewarm)
 
     with open(f'output_after_encryption_{d1}_{t1}.csv', 'w', newline='') as csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(columns)
         csvwriter.writerows(data)
+
+    failed = [row for row in data if row[-1] != 'success']
+    print(f'*** {len(data) - len(failed)} of {len(data)} volumes encrypted')
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,35 +1,48 @@
-import boto3
+import argparse
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common import rate_limiter
+from common.aws_clients import lazy_client
+from ec2.batch_waiter import BatchWaiter
 
 region = 'ap-south-1'  # change it
 kms_key_id = ''  # Puth KMS key in quotes
 
-ec2 = boto3.resource('ec2')
+# default quota for concurrent snapshot copies per destination region
+max_copies = 20
+
+client = lazy_client('ec2')
+waiter = BatchWaiter(client, delay=20)
 
-client = boto3.client('ec2')
 
-snap_list = client.describe_snapshots(
-    OwnerIds=['self'],
-    Filters=[
-        {
-            'Name': 'encrypted',
-            'Values': [
-                'false'
-            ]
-        },
-    ],
-)
+def get_unencrypted_snapshots():
+    paginator = client.get_paginator('describe_snapshots')
+    pages = paginator.paginate(
+        OwnerIds=['self'],
+        Filters=[
+            {
+                'Name': 'encrypted',
+                'Values': [
+                    'false'
+                ]
+            },
+        ],
+    )
+    for page in pages:
+        yield from page['Snapshots']
 
-snapshot_list = snap_list['Snapshots']
 
-for i in snapshot_list:
-    snap_id = i['SnapshotId']
-    vol_id = i["VolumeId"]
+def copy_snapshot(snap_id, vol_id):
     print('Copying Snapshot for :', snap_id)
-    snapshot = ec2.Snapshot(snap_id)
-    response = snapshot.copy(
+    kms_args = {'KmsKeyId': kms_key_id} if kms_key_id else {}
+    response = client.copy_snapshot(
+        SourceSnapshotId=snap_id,
         Description=f'Encrypted snapshot for {snap_id}',
         Encrypted=True,
-        KmsKeyId=kms_key_id,
         SourceRegion=region,
         TagSpecifications=[
             {
@@ -45,12 +58,71 @@ for i in snapshot_list:
                     }
                 ]
             },
-        ]
+        ],
+        **kms_args
     )
     print(f"Waiting for snapshot to complete: {response['SnapshotId']}")
-    client.get_waiter('snapshot_completed').wait(SnapshotIds=[response["SnapshotId"]], WaiterConfig={
-        'Delay': 20,
-        'MaxAttempts': 100
-    })
+    waiter.wait('snapshot', response['SnapshotId'], 'completed', timeout=2000)
     print(
-        f'*** Snapshot encrypted for {snap_id} new snapshotId: {snapshot.id}')
+        f"*** Snapshot encrypted for {snap_id} new snapshotId: {response['SnapshotId']}")
+
+    return response['SnapshotId']
+
+
+def encrypt_snapshots(snapshots, max_copies=max_copies):
+    """
+    Copies every snapshot with at most max_copies copies in flight.
+
+    The listing is consumed lazily: a new copy starts as soon as a slot
+    frees, and a failed copy is reported without stopping the others.
+    """
+    copied = []
+    failed = []
+    started = 0
+    lock = threading.Lock()
+    slots = threading.BoundedSemaphore(max_copies)
+
+    def run(snapshot):
+        snap_id = snapshot['SnapshotId']
+        try:
+            new_snap_id = copy_snapshot(snap_id, snapshot['VolumeId'])
+            with lock:
+                copied.append((snap_id, new_snap_id))
+        except Exception as e:
+            print(f'***ERROR*** Copy failed for {snap_id}: {e}')
+            with lock:
+                failed.append((snap_id, str(e)))
+        finally:
+            slots.release()
+        with lock:
+            print(f'*** Progress: {len(copied)} completed, {len(failed)} failed, '
+                  f'{started - len(copied) - len(failed)} in flight')
+
+    with ThreadPoolExecutor(max_workers=max_copies) as executor:
+        for snapshot in snapshots:
+            slots.acquire()
+            with lock:
+                started += 1
+            executor.submit(run, snapshot)
+
+    return copied, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Make an encrypted copy of every unencrypted snapshot')
+    parser.add_argument('--max-copies', type=int, default=max_copies,
+                        help='number of copies in flight, up to the account quota')
+    args = parser.parse_args()
+
+    rate_limiter.enable()
+
+    copied, failed = encrypt_snapshots(get_unencrypted_snapshots(), args.max_copies)
+
+    print(f'*** {len(copied)} snapshots encrypted, {len(failed)} failed')
+    if failed:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
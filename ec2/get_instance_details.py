@@ -1,27 +1,65 @@
-import boto3
+import argparse
 import csv
+import os
+import sys
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import lazy_client
+
 t = datetime.now()
 d1 = t.strftime("%b-%d-%Y")
 t1 = t.strftime('%H-%M-%S')
 
-client = boto3.client('ec2')
+client = lazy_client('ec2')
 
 instance_state = "running" # pending | running | shutting-down | terminated | stopping | stopped
 tag_key = 'Name'  # could be any tag key
 tag_values = ['FSS']  # could be any tag value
-device = '/dev/xvda' # put device name
-
-
-data = []
-columns = ['instance_id', 'root_volume_id', 'size',
-           'AvailabilityZone', 'instance_state']
-
-
-def get_instances():
-
-    response = client.describe_instances(Filters=[
+device = None # put a device name like '/dev/xvda' to only list that device
+
+
+columns = ['instance_id', 'volume_id', 'device', 'size',
+           'AvailabilityZone', 'instance_state', 'volume_type', 'iops', 'throughput']
+
+# EC2 accepts at most 200 values per filter
+chunk_size = 200
+
+
+def get_volumes(instance_ids):
+    """
+    Yields the unencrypted volumes attached to any of the instances (as `device`
+    when it is set), using one paginated describe_volumes call per chunk of
+    instance ids.
+    """
+    paginator = client.get_paginator('describe_volumes')
+    for i in range(0, len(instance_ids), chunk_size):
+        filters = [
+            {
+                'Name': 'attachment.instance-id',
+                'Values': instance_ids[i:i + chunk_size]
+
+            },
+            {
+                'Name': 'encrypted',
+                'Values': ['false']
+
+            }
+        ]
+        if device:
+            filters.append({'Name': 'attachment.device', 'Values': [device]})
+        pages = paginator.paginate(Filters=filters)
+        for page in pages:
+            yield from page['Volumes']
+
+
+def iter_instance_pages():
+    """
+    Yields the csv rows of one page of instances at a time, one row per
+    matching volume, so every instance's volumes arrive together.
+    """
+    paginator = client.get_paginator('describe_instances')
+    pages = paginator.paginate(Filters=[
         {
             'Name': 'instance-state-name',
             'Values': [
@@ -34,43 +72,52 @@ def get_instances():
 
         }
     ])
-    reservations = response['Reservations']
-    for i in reservations:
-        for j in i['Instances']:
-            instance_id = (j['InstanceId'])
-            response_vol = client.describe_volumes(
-                Filters=[
-                    {
-                        'Name': 'attachment.instance-id',
-                        'Values': [instance_id]
-
-                    },
-                    {
-                        'Name': 'attachment.device',
-                        'Values': [device]
-
-                    },
-                    {
-                        'Name': 'encrypted',
-                        'Values': ['false']
-
-                    }
-                ]
-            )
-
-            for i in response_vol['Volumes']:
-                root_vol = i["VolumeId"]
-                size = i['Size']
-                az = i['AvailabilityZone']
-
-                row = [instance_id, root_vol, size, az, instance_state]
-                print(row)
-                data.append(row)
+    for page in pages:
+        instance_ids = [j['InstanceId']
+                        for i in page['Reservations'] for j in i['Instances']]
+        if not instance_ids:
+            continue
+
+        page_instances = set(instance_ids)
+        rows = []
+        for i in get_volumes(instance_ids):
+            for attachment in i['Attachments']:
+                if device and attachment['Device'] != device:
+                    continue
+                if attachment['InstanceId'] in page_instances:
+                    instance_id = attachment['InstanceId']
+                    volume_id = i["VolumeId"]
+                    size = i['Size']
+                    az = i['AvailabilityZone']
+
+                    rows.append([instance_id, volume_id, attachment['Device'], size, az,
+                                 instance_state, i['VolumeType'], i.get('Iops'), i.get('Throughput')])
+        yield rows
+
+
+def iter_instance_rows():
+    """
+    Yields one csv row per matching instance volume, a page of instances at a time.
+    """
+    for rows in iter_instance_pages():
+        yield from rows
+
+
+def get_instances():
 
     with open(f'output_{d1}_{t1}.csv', 'w', newline='') as csvfile:
         csvwriter = csv.writer(csvfile)
         csvwriter.writerow(columns)
-        csvwriter.writerows(data)
+        for row in iter_instance_rows():
+            print(row)
+            csvwriter.writerow(row)
+
+
+def main():
+    argparse.ArgumentParser(
+        description='Write the unencrypted volumes of the tagged instances to a csv').parse_args()
+    get_instances()
 
 
-get_instances()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+
+class Journal:
+    """
+    Append-only journal of the steps finished by encrypt_ebs.py.
+
+    Each record is one JSON line and is fsync'd before record() returns, so
+    whatever is in the file survives a crash of the process or the host.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'a')
+
+    def record(self, instance_id, step, **fields):
+        """
+        Appends one step result for an instance.
+
+        Args:
+            instance_id (str): The instance the step belongs to.
+            step (str): The step name, e.g. 'snapshot_started' or 'done'.
+            **fields: Step results such as snapshot_id or new_volume_id.
+
+        Returns:
+            None
+        """
+        entry = {'time': datetime.now().isoformat(),
+                 'instance_id': instance_id, 'step': step, **fields}
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_journal(path):
+    """
+    Replays a journal into the last known state of every instance.
+
+    A 'begin' record starts the instance over, so only the steps of its most
+    recent attempt are returned. A 'failed' record is kept out of the state,
+    which lets a resumed run retry from the last finished step.
+
+    Args:
+        path (str): The journal written by Journal.
+
+    Returns:
+        dict: instance_id -> {step: record}
+    """
+    state = {}
+    if not os.path.exists(path):
+        return state
+
+    with open(path) as journal_file:
+        for line in journal_file:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # a torn last line from a crash mid-write
+                continue
+            instance_id = entry['instance_id']
+            step = entry['step']
+            if step == 'begin':
+                state[instance_id] = {}
+            if step != 'failed':
+                state.setdefault(instance_id, {})[step] = entry
+
+    return state
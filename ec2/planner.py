@@ -0,0 +1,233 @@
+'''
+: Predict how long encrypt_ebs.py will take before running it
+: Step durations are learned from earlier journals, snapshot and
+: volume creation as a fixed part plus seconds per GB
+
+'''
+import heapq
+import itertools
+from datetime import datetime
+
+from ec2.journal import load_journal
+
+# used until a journal has enough finished instances; seconds, or (fixed, per GB)
+DEFAULT_MODEL = {
+    'stop': 60,
+    'snapshot': (60, 6.0),
+    'incremental': (60, 0.3),
+    'detach': 10,
+    'volume': (30, 0.5),
+    'attach': 10,
+    'start': 60,
+}
+
+# step -> (journal step it starts after, journal step it ends with), timed
+# for every volume from its own journal entries
+VOLUME_STEPS = {
+    'baseline': ('baseline_started', 'baseline_completed'),
+    'snapshot': ('snapshot_started', 'snapshot_completed'),
+    'detach': ('snapshot_completed', 'detached'),
+    'volume': ('volume_created', 'volume_available'),
+    'attach': ('volume_available', 'attached'),
+}
+
+# timed from the last volume reaching the first journal step to the last one
+# reaching the second
+INSTANCE_STEPS = {
+    'stop': ('begin', 'stopped'),
+    'start': ('attached', 'started'),
+}
+
+
+def fit_line(points):
+    """Least-squares (fixed, per GB) through (size, seconds) points."""
+    n = len(points)
+    mean_size = sum(size for size, _ in points) / n
+    mean_seconds = sum(seconds for _, seconds in points) / n
+    variance = sum((size - mean_size) ** 2 for size, _ in points)
+    if not variance:
+        return (0, mean_seconds / mean_size) if mean_size else (mean_seconds, 0)
+    per_gb = sum((size - mean_size) * (seconds - mean_seconds) for size, seconds in points) / variance
+    per_gb = max(per_gb, 0)
+    return (max(mean_seconds - per_gb * mean_size, 0), per_gb)
+
+
+def reached(state, step, volume_ids):
+    """When the last volume reached step, or None if one of them has not."""
+    if step in state:
+        entries = [state[step]]
+    else:
+        entries = [state.get(f'{step}:{volume_id}') for volume_id in volume_ids]
+        if None in entries:
+            return None
+    return max(datetime.fromisoformat(entry['time']) for entry in entries)
+
+
+def learn_model(journal_path):
+    """
+    Learns the step durations from a journal written by encrypt_ebs.py.
+
+    Args:
+        journal_path (str): The journal to learn from.
+
+    Returns:
+        dict: Step -> seconds, or (fixed, per GB) for snapshot and volume.
+    """
+    samples = {step: [] for step in DEFAULT_MODEL}
+    for instance_id, state in load_journal(journal_path).items():
+        if 'begin' not in state:
+            continue
+        begin = state['begin']
+        # journals from before multi-volume support have one unsuffixed volume
+        volumes = begin.get('volumes') or [{'volume_id': None, 'size': begin['size']}]
+        volume_ids = [volume['volume_id'] for volume in volumes]
+        prewarmed = reached(state, 'baseline_completed', volume_ids) is not None
+
+        for volume in volumes:
+            for step, (first, last) in VOLUME_STEPS.items():
+                started = reached(state, first, [volume['volume_id']])
+                completed = reached(state, last, [volume['volume_id']])
+                if started and completed:
+                    # a baseline is a full snapshot and the snapshot after it an incremental one
+                    if step == 'baseline':
+                        step = 'snapshot'
+                    elif step == 'snapshot' and prewarmed:
+                        step = 'incremental'
+                    samples[step].append((volume['size'], (completed - started).total_seconds()))
+
+        size = begin['size']
+        for step, (first, last) in INSTANCE_STEPS.items():
+            if step == 'stop' and prewarmed:
+                # the stop is requested once the baselines are done
+                first = 'baseline_completed'
+            started = reached(state, first, volume_ids)
+            completed = reached(state, last, volume_ids)
+            if started and completed:
+                samples[step].append((size, (completed - started).total_seconds()))
+
+    model = dict(DEFAULT_MODEL)
+    for step, points in samples.items():
+        if len(points) < 2:
+            continue
+        if isinstance(DEFAULT_MODEL[step], tuple):
+            model[step] = fit_line(points)
+        else:
+            model[step] = sum(seconds for _, seconds in points) / len(points)
+    return model
+
+
+def step_seconds(model, step, size):
+    if isinstance(model[step], tuple):
+        fixed, per_gb = model[step]
+        return fixed + per_gb * size
+    return model[step]
+
+
+def estimate(job, model, prewarm=False):
+    """
+    The volumes of an instance go through their snapshot, new volume and
+    attach steps side by side, so the instance is down for as long as its
+    slowest volume needs.
+
+    Returns:
+        tuple: (seconds for the whole pipeline, seconds the instance is down)
+    """
+    sizes = [int(volume['size']) for volume in job['volumes']]
+    running = job['instance_state'] == 'running'
+    snapshot = 'incremental' if prewarm and running else 'snapshot'
+
+    def volume_seconds(size):
+        return (step_seconds(model, snapshot, size) +
+                max(model['detach'], step_seconds(model, 'volume', size)) + model['attach'])
+
+    baseline = max(step_seconds(model, 'snapshot', size) for size in sizes) if prewarm and running else 0
+    downtime = model['stop'] + max(volume_seconds(size) for size in sizes)
+    if running:
+        downtime += model['start']
+    return baseline + downtime, downtime if running else 0
+
+
+def largest(job):
+    return max(int(volume['size']) for volume in job['volumes'])
+
+
+class Dispatcher:
+    """
+    The order in which encrypt_fleet starts instances, and plan simulates it.
+
+    Waiting jobs are kept per AvailabilityZone, largest volume first (LPT),
+    and the AZs with the largest waiting volume are served first, so long
+    jobs start early. At most max_workers jobs run at once and at most
+    max_per_az of them in the same AZ.
+    """
+
+    def __init__(self, max_workers=1, max_per_az=None):
+        self.max_workers = max_workers
+        self.max_per_az = max_per_az or max_workers
+        # AZ -> heap of (-largest volume, arrival, job)
+        self.pending = {}
+        self.in_flight = {}
+        self.running = 0
+        self._arrival = itertools.count()
+
+    def add(self, job):
+        az = job['AvailabilityZone']
+        heapq.heappush(self.pending.setdefault(az, []), (-largest(job), next(self._arrival), job))
+        self.in_flight.setdefault(az, 0)
+
+    def start(self):
+        """Takes the jobs that can start now, in the order to start them."""
+        started = []
+        for az in sorted(self.pending, key=lambda az: self.pending[az][0][0]):
+            while self.running < self.max_workers and self.in_flight[az] < self.max_per_az \
+                    and self.pending[az]:
+                _, _, job = heapq.heappop(self.pending[az])
+                self.in_flight[az] += 1
+                self.running += 1
+                started.append(job)
+            if not self.pending[az]:
+                del self.pending[az]
+        return started
+
+    def finished(self, job):
+        self.in_flight[job['AvailabilityZone']] -= 1
+        self.running -= 1
+
+
+def plan(jobs, model, max_workers=1, max_per_az=None, prewarm=False):
+    """
+    Simulates encrypt_fleet's dispatching with the learned durations, with
+    the same Dispatcher.
+
+    Returns:
+        tuple: (list of (job, start, seconds, downtime), makespan in seconds)
+    """
+    dispatcher = Dispatcher(max_workers, max_per_az)
+    for job in jobs:
+        dispatcher.add(job)
+    running = []
+    schedule = []
+    now = 0
+    while dispatcher.pending or running:
+        for job in dispatcher.start():
+            seconds, downtime = estimate(job, model, prewarm)
+            heapq.heappush(running, (now + seconds, len(schedule), job))
+            schedule.append((job, now, seconds, downtime))
+        now, _, job = heapq.heappop(running)
+        dispatcher.finished(job)
+    return schedule, now
+
+
+def print_plan(schedule, makespan):
+    print(f"{'INSTANCE':<20} {'AZ':<16} {'VOLS':>4} {'GB':>6} {'START':>9} {'DURATION':>9} "
+          f"{'DOWNTIME':>9}")
+    for job, start, seconds, downtime in sorted(schedule, key=lambda item: item[1]):
+        size = sum(int(volume['size']) for volume in job['volumes'])
+        print(f"{job['instance_id']:<20} {job['AvailabilityZone']:<16} {len(job['volumes']):>4} {size:>6} "
+              f"{minutes(start):>9} {minutes(seconds):>9} {minutes(downtime):>9}")
+    serial = sum(seconds for _, _, seconds, _ in schedule)
+    print(f'*** Predicted makespan: {minutes(makespan)} (one at a time: {minutes(serial)})')
+
+
+def minutes(seconds):
+    return f'{int(seconds // 60)}m{int(seconds % 60):02d}s'
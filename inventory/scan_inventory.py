@@ -0,0 +1,166 @@
+'''
+: Scan EC2 volumes, RDS instances and Redshift clusters
+: for every profile x region at the same time
+: Write one parquet dataset partitioned by resource_type, profile and region
+
+'''
+import argparse
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import get_client
+
+profiles = ['DEV', 'TEST', 'UAT', 'PROD']
+regions = ['ap-south-1']
+
+columns = ['profile', 'account_id', 'region', 'resource_type', 'resource_id', 'state',
+           'availability_zone', 'size_gb', 'encrypted', 'instance_type', 'volume_type', 'attached_to', 'scanned_at']
+
+
+def scan_ec2_volumes(profile_name, region_name):
+    client = get_client('ec2', profile_name=profile_name, region_name=region_name)
+    for page in client.get_paginator('describe_volumes').paginate():
+        for volume in page['Volumes']:
+            attachments = volume.get('Attachments', [])
+            yield {
+                'resource_type': 'ec2_volume',
+                'resource_id': volume['VolumeId'],
+                'state': volume['State'],
+                'availability_zone': volume['AvailabilityZone'],
+                'size_gb': volume['Size'],
+                'encrypted': volume['Encrypted'],
+                'instance_type': None,
+                'volume_type': volume['VolumeType'],
+                'attached_to': attachments[0]['InstanceId'] if attachments else None,
+            }
+
+
+def scan_rds_instances(profile_name, region_name):
+    client = get_client('rds', profile_name=profile_name, region_name=region_name)
+    for page in client.get_paginator('describe_db_instances').paginate():
+        for instance in page['DBInstances']:
+            yield {
+                'resource_type': 'rds_instance',
+                'resource_id': instance['DBInstanceIdentifier'],
+                'state': instance['DBInstanceStatus'],
+                'availability_zone': instance.get('AvailabilityZone'),
+                'size_gb': instance['AllocatedStorage'],
+                'encrypted': instance['StorageEncrypted'],
+                'instance_type': instance['DBInstanceClass'],
+                'volume_type': instance['StorageType'],
+                'attached_to': None,
+            }
+
+
+def scan_redshift_clusters(profile_name, region_name):
+    client = get_client('redshift', profile_name=profile_name, region_name=region_name)
+    for page in client.get_paginator('describe_clusters').paginate():
+        for cluster in page['Clusters']:
+            yield {
+                'resource_type': 'redshift_cluster',
+                'resource_id': cluster['ClusterIdentifier'],
+                'state': cluster['ClusterStatus'],
+                'availability_zone': cluster.get('AvailabilityZone'),
+                'size_gb': None,
+                'encrypted': cluster['Encrypted'],
+                'instance_type': cluster['NodeType'],
+                'volume_type': None,
+                'attached_to': None,
+            }
+
+
+scanners = {
+    'ec2_volume': scan_ec2_volumes,
+    'rds_instance': scan_rds_instances,
+    'redshift_cluster': scan_redshift_clusters,
+}
+
+
+def scan(profile_name, region_name, scanner):
+    """
+    Runs one scanner for one profile and region.
+
+    Returns:
+        list: The inventory rows, tagged with their profile, account and region.
+    """
+    account_id = get_client('sts', profile_name=profile_name).get_caller_identity()['Account']
+    scanned_at = datetime.now(timezone.utc)
+    rows = []
+    for row in scanner(profile_name, region_name):
+        row.update(profile=profile_name, account_id=account_id,
+                   region=region_name, scanned_at=scanned_at)
+        rows.append(row)
+    return rows
+
+
+def scan_all(profile_names, region_names, max_workers=16):
+    """
+    Scans every profile x region x service combination concurrently.
+
+    A combination that fails (missing profile, disabled region, denied
+    permission) is reported and left out of the result.
+
+    Returns:
+        tuple: A pandas.DataFrame with one row per resource, and the lists of
+            (resource_type, profile, region) combinations that were scanned
+            and that failed.
+    """
+    import pandas as pd
+
+    rows = []
+    scanned = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(scan, profile_name, region_name, scanner):
+                (resource_type, profile_name, region_name)
+            for profile_name in profile_names
+            for region_name in region_names
+            for resource_type, scanner in scanners.items()
+        }
+        for future in as_completed(futures):
+            resource_type, profile_name, region_name = futures[future]
+            try:
+                found = future.result()
+            except Exception as e:
+                print(f'***ERROR*** {resource_type} scan failed for {profile_name}/{region_name}: {e}')
+                failed.append(futures[future])
+                continue
+            print(f'*** {resource_type} {profile_name}/{region_name}: {len(found)} resources')
+            scanned.append(futures[future])
+            rows.extend(found)
+
+    return pd.DataFrame(rows, columns=columns), scanned, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Scan EC2 volumes, RDS instances and Redshift clusters across profiles and regions')
+    parser.add_argument('--profiles', nargs='+', default=profiles)
+    parser.add_argument('--regions', nargs='+', default=regions)
+    parser.add_argument('--workers', type=int, default=16,
+                        help='number of profile/region/service scans run at the same time')
+    parser.add_argument('--output', default='inventory',
+                        help='directory of the parquet dataset')
+    args = parser.parse_args()
+
+    df, scanned, failed = scan_all(args.profiles, args.regions, args.workers)
+    # a rescan replaces the data of every scan that succeeded, also when it found
+    # nothing; the profiles, regions and services not scanned or failed keep theirs
+    for resource_type, profile_name, region_name in scanned:
+        partition = os.path.join(args.output, f'resource_type={resource_type}',
+                                 f'profile={profile_name}', f'region={region_name}')
+        if os.path.isdir(partition):
+            shutil.rmtree(partition)
+    if not df.empty:
+        df.to_parquet(args.output, partition_cols=['resource_type', 'profile', 'region'], index=False,
+                      existing_data_behavior='delete_matching')
+    print(f'*** {len(df)} resources written to {args.output}, {len(failed)} scans failed')
+
+
+if __name__ == '__main__':
+    main()
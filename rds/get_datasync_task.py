@@ -1,6 +1,19 @@
-import boto3
+import argparse
+import os
+import sys
 
-client = boto3.client('datasync')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import lazy_client
 
-response = client.list_tasks()
-print(response)
\ No newline at end of file
+client = lazy_client('datasync')
+
+
+def main():
+    argparse.ArgumentParser(description='List the DataSync tasks').parse_args()
+
+    response = client.list_tasks()
+    print(response)
+
+
+if __name__ == '__main__':
+    main()
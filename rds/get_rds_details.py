@@ -1,16 +1,32 @@
-import boto3
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import lazy_client
+
 target_env_identifier = 'qa1'
 
-client = boto3.client('rds')
+client = lazy_client('rds')
 
 
-def describe_instance():
+def describe_instance(instance_identifier=target_env_identifier):
     print("** getting instance details")
     response = client.describe_db_instances(
-        DBInstanceIdentifier=target_env_identifier,
+        DBInstanceIdentifier=instance_identifier,
     )
     print("** details fetched")
     return (response)
 
-response = describe_instance()
-print(response)
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description='Print the details of an RDS instance')
+    parser.add_argument('identifier', nargs='?', default=target_env_identifier)
+    args = parser.parse_args()
+
+    response = describe_instance(args.identifier)
+    print(response)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,29 @@
-import boto3
+import argparse
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import lazy_client
+from common.polling import poll
+from common.workflow import RetryPolicy, Step, Workflow
+
 t = datetime.now()
 d1 = t.strftime("%b-%d-%Y")
 t1 = t.strftime('%H-%M-%S')
 
 prd_identifier = 'prd'
 target_env_identifier = 'qa1'
+snapshot_identifier = f'{prd_identifier}-snap-{d1}-{t1}'
 
-client = boto3.client('rds')
+client = lazy_client('rds')
 
 
-def describe_instance():
+def describe_instance(instance_identifier=target_env_identifier):
     print("** getting instance details")
     response = client.describe_db_instances(
-        DBInstanceIdentifier=target_env_identifier,
+        DBInstanceIdentifier=instance_identifier,
     )
     print("** details fetched")
     return (response)
@@ -23,7 +32,7 @@ def describe_instance():
 def take_snapshot():
     print("** taking production snapshot")
     client.create_db_snapshot(
-        DBSnapshotIdentifier=f'{prd_identifier}-snap-{d1}-{t1}',
+        DBSnapshotIdentifier=snapshot_identifier,
         DBInstanceIdentifier=prd_identifier,
         Tags=[
             {
@@ -39,7 +48,7 @@ def take_snapshot():
     print("** snapshot taken waiting it to complete")
     client.get_waiter('db_snapshot_completed').wait(
         DBInstanceIdentifier=prd_identifier,
-        DBSnapshotIdentifier=f'{prd_identifier}-snap-{d1}-{t1}',
+        DBSnapshotIdentifier=snapshot_identifier,
         Filters=[
             {
                 'Name': 'db-instance-id',
@@ -55,35 +64,78 @@ def take_snapshot():
         }
     )
     print("** snapshot completed")
+    return snapshot_identifier
+
 
+def latest_snapshot():
+    """Identifier of the newest available production snapshot, manual or automated."""
+    snapshots = []
+    paginator = client.get_paginator('describe_db_snapshots')
+    for page in paginator.paginate(DBInstanceIdentifier=prd_identifier):
+        snapshots += [snapshot for snapshot in page['DBSnapshots'] if snapshot['Status'] == 'available']
+    if not snapshots:
+        raise RuntimeError(f'no available snapshot of {prd_identifier}')
+    latest = max(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'])
+    print(f"** latest production snapshot: {latest['DBSnapshotIdentifier']}",
+          f"taken {latest['SnapshotCreateTime']}")
+    return latest['DBSnapshotIdentifier']
 
-def delete_db():
-    print(f"** deleting old instance for {target_env_identifier}")
+
+def delete_db(instance_identifier=target_env_identifier, wait=True):
+    print(f"** deleting old instance for {instance_identifier}")
     client.delete_db_instance(
-        DBInstanceIdentifier=target_env_identifier,
+        DBInstanceIdentifier=instance_identifier,
         SkipFinalSnapshot=False,
-        FinalDBSnapshotIdentifier=f'{target_env_identifier}-final-snap-{d1}-{t1}',
+        FinalDBSnapshotIdentifier=f'{instance_identifier}-final-snap-{d1}-{t1}',
         DeleteAutomatedBackups=True
     )
-    print(f"** waiting instance {target_env_identifier} to be deleted")
+    if not wait:
+        print(f"** instance {instance_identifier} is being deleted in the background",
+              f"final snapshot identifier: {instance_identifier}-final-snap-{d1}-{t1}")
+        return
+    print(f"** waiting instance {instance_identifier} to be deleted")
     client.get_waiter('db_instance_deleted').wait(
-        DBInstanceIdentifier=target_env_identifier,
+        DBInstanceIdentifier=instance_identifier,
         WaiterConfig={
             'Delay': 15,
             'MaxAttempts': 100
         }
     )
-    print(f"** instance {target_env_identifier} deleted",
-          f"final snapshot identifier: {target_env_identifier}-final-snap-{d1}-{t1}")
+    print(f"** instance {instance_identifier} deleted",
+          f"final snapshot identifier: {instance_identifier}-final-snap-{d1}-{t1}")
+
+
+def rename_db(instance_identifier, new_instance_identifier):
+    print(f"** renaming instance {instance_identifier} to {new_instance_identifier}")
+    client.modify_db_instance(
+        DBInstanceIdentifier=instance_identifier,
+        NewDBInstanceIdentifier=new_instance_identifier,
+        ApplyImmediately=True
+    )
+
+    def get_status():
+        try:
+            response = client.describe_db_instances(
+                DBInstanceIdentifier=new_instance_identifier)
+        except client.exceptions.DBInstanceNotFoundFault:
+            # the new name becomes visible only once the rename has started
+            return 'renaming'
+        return response['DBInstances'][0]['DBInstanceStatus']
+
+    poll(get_status, is_done=lambda status: status == 'available',
+         is_failed=lambda status: status in ('failed', 'deleting', 'incompatible-parameters'),
+         description=f'instance {new_instance_identifier} to be available', timeout=1800)
+    print(f"** instance {instance_identifier} renamed to {new_instance_identifier}")
 
 
 def restore_snapshot(DBInstanceClass, Port, AvailabilityZone, DBSubnetGroupName, MultiAZ, PubliclyAccessible, AutoMinorVersionUpgrade, LicenseModel,
-                     Engine, OptionGroupName, StorageType, VpcSecurityGroupIdsList, DBParameterGroupName, BackupTarget, NetworkType, TagList):
+                     Engine, OptionGroupName, StorageType, VpcSecurityGroupIdsList, DBParameterGroupName, BackupTarget, NetworkType, TagList,
+                     instance_identifier=target_env_identifier, snapshot_identifier=snapshot_identifier):
     print(
-        f"** restoring latest production snapshot to {target_env_identifier}")
+        f"** restoring production snapshot {snapshot_identifier} to {instance_identifier}")
     client.restore_db_instance_from_db_snapshot(
-        DBInstanceIdentifier=target_env_identifier,
-        DBSnapshotIdentifier=f'{prd_identifier}-snap-{d1}-{t1}',
+        DBInstanceIdentifier=instance_identifier,
+        DBSnapshotIdentifier=snapshot_identifier,
         DBInstanceClass=DBInstanceClass,
         Port=Port,
         AvailabilityZone=AvailabilityZone,
@@ -103,60 +155,154 @@ def restore_snapshot(DBInstanceClass, Port, AvailabilityZone, DBSubnetGroupName,
         BackupTarget=BackupTarget,
         NetworkType=NetworkType
     )
-    print(f"** waiting instance {target_env_identifier} to be available")
+    print(f"** waiting instance {instance_identifier} to be available")
     client.get_waiter('db_instance_available').wait(
-        DBInstanceIdentifier=target_env_identifier,
+        DBInstanceIdentifier=instance_identifier,
         WaiterConfig={
             'Delay': 15,
             'MaxAttempts': 150
         }
     )
-    print(f"** instance {target_env_identifier} is available")
-
-
-print('*** Process Started')
-response = describe_instance()
-DBInstanceClass = response['DBInstances'][0]['DBInstanceClass']
-Endpoint = response['DBInstances'][0]['Endpoint']['Address']
-Port = response['DBInstances'][0]['Endpoint']['Port']
-AvailabilityZone = response['DBInstances'][0]['AvailabilityZone']
-DBSubnetGroupName = response['DBInstances'][0]['DBSubnetGroup']['DBSubnetGroupName']
-MultiAZ = response['DBInstances'][0]['MultiAZ']
-PubliclyAccessible = response['DBInstances'][0]['PubliclyAccessible']
-AutoMinorVersionUpgrade = response['DBInstances'][0]['AutoMinorVersionUpgrade']
-LicenseModel = response['DBInstances'][0]['LicenseModel']
-Engine = response['DBInstances'][0]['Engine']
-OptionGroupName = response['DBInstances'][0]['OptionGroupMemberships'][0]['OptionGroupName']
-StorageType = response['DBInstances'][0]['StorageType']
-VpcSecurityGroupIds = response['DBInstances'][0]['VpcSecurityGroups']
-VpcSecurityGroupIdsList = [value for i in VpcSecurityGroupIds for key,
-                           value in i.items() if key == "VpcSecurityGroupId"]
-DBParameterGroupName = response['DBInstances'][0]['DBParameterGroups'][0]['DBParameterGroupName']
-BackupTarget = response['DBInstances'][0]['BackupTarget']
-NetworkType = response['DBInstances'][0]['NetworkType']
-TagList = response['DBInstances'][0]['TagList']
-
-print('*** DBInstanceClass:', DBInstanceClass)
-print('*** Port:', Port)
-print('*** Endpoint:', Endpoint)
-print('*** AvailabilityZone:', AvailabilityZone)
-print('*** DBSubnetGroupName:', DBSubnetGroupName)
-print('*** MultiAZ:', MultiAZ)
-print('*** PubliclyAccessible:', PubliclyAccessible)
-print('*** AutoMinorVersionUpgrade:', AutoMinorVersionUpgrade)
-print('*** LicenseModel:', LicenseModel)
-print('*** Engine:', Engine)
-print('*** OptionGroupName:', OptionGroupName)
-print('*** StorageType:', StorageType)
-print('*** VpcSecurityGroupIds:', VpcSecurityGroupIds)
-print('*** VpcSecurityGroupIdsList:', VpcSecurityGroupIdsList)
-print('*** DBParameterGroupName:', DBParameterGroupName)
-print('*** BackupTarget:', BackupTarget)
-print('*** NetworkType:', NetworkType)
-print('*** TagList:', TagList)
-
-take_snapshot()
-delete_db()
-restore_snapshot(DBInstanceClass, Port, AvailabilityZone, DBSubnetGroupName, MultiAZ, PubliclyAccessible, AutoMinorVersionUpgrade, LicenseModel,
-                 Engine, OptionGroupName, StorageType, VpcSecurityGroupIdsList, DBParameterGroupName, BackupTarget, NetworkType, TagList)
-print('*** Process Finished Successfully')
+    print(f"** instance {instance_identifier} is available")
+
+
+def blue_green_restore(*restore_args, instance_identifier=target_env_identifier,
+                       snapshot_identifier=snapshot_identifier):
+    """
+    Restores the production snapshot next to the target and swaps them.
+
+    The old target keeps serving while the new instance is restored under a
+    temporary identifier. The identifiers are then swapped by renaming, so
+    the endpoint only changes hands for the length of the two renames, and
+    the old instance is deleted (with its final snapshot) in the background.
+    """
+    new_identifier = f'{instance_identifier}-new'
+    old_identifier = f'{instance_identifier}-old-{d1}-{t1}'.lower()
+
+    restore_snapshot(*restore_args, instance_identifier=new_identifier,
+                     snapshot_identifier=snapshot_identifier)
+    rename_db(instance_identifier, old_identifier)
+    rename_db(new_identifier, instance_identifier)
+    delete_db(old_identifier, wait=False)
+
+
+def get_restore_args(instance_identifier=target_env_identifier):
+    """Captures the settings of an instance that its restored copy has to keep."""
+    response = describe_instance(instance_identifier)
+    DBInstanceClass = response['DBInstances'][0]['DBInstanceClass']
+    Endpoint = response['DBInstances'][0]['Endpoint']['Address']
+    Port = response['DBInstances'][0]['Endpoint']['Port']
+    AvailabilityZone = response['DBInstances'][0]['AvailabilityZone']
+    DBSubnetGroupName = response['DBInstances'][0]['DBSubnetGroup']['DBSubnetGroupName']
+    MultiAZ = response['DBInstances'][0]['MultiAZ']
+    PubliclyAccessible = response['DBInstances'][0]['PubliclyAccessible']
+    AutoMinorVersionUpgrade = response['DBInstances'][0]['AutoMinorVersionUpgrade']
+    LicenseModel = response['DBInstances'][0]['LicenseModel']
+    Engine = response['DBInstances'][0]['Engine']
+    OptionGroupName = response['DBInstances'][0]['OptionGroupMemberships'][0]['OptionGroupName']
+    StorageType = response['DBInstances'][0]['StorageType']
+    VpcSecurityGroupIds = response['DBInstances'][0]['VpcSecurityGroups']
+    VpcSecurityGroupIdsList = [value for i in VpcSecurityGroupIds for key,
+                               value in i.items() if key == "VpcSecurityGroupId"]
+    DBParameterGroupName = response['DBInstances'][0]['DBParameterGroups'][0]['DBParameterGroupName']
+    BackupTarget = response['DBInstances'][0]['BackupTarget']
+    NetworkType = response['DBInstances'][0]['NetworkType']
+    TagList = response['DBInstances'][0]['TagList']
+
+    print(f'*** {instance_identifier}')
+    print('*** DBInstanceClass:', DBInstanceClass)
+    print('*** Port:', Port)
+    print('*** Endpoint:', Endpoint)
+    print('*** AvailabilityZone:', AvailabilityZone)
+    print('*** DBSubnetGroupName:', DBSubnetGroupName)
+    print('*** MultiAZ:', MultiAZ)
+    print('*** PubliclyAccessible:', PubliclyAccessible)
+    print('*** AutoMinorVersionUpgrade:', AutoMinorVersionUpgrade)
+    print('*** LicenseModel:', LicenseModel)
+    print('*** Engine:', Engine)
+    print('*** OptionGroupName:', OptionGroupName)
+    print('*** StorageType:', StorageType)
+    print('*** VpcSecurityGroupIds:', VpcSecurityGroupIds)
+    print('*** VpcSecurityGroupIdsList:', VpcSecurityGroupIdsList)
+    print('*** DBParameterGroupName:', DBParameterGroupName)
+    print('*** BackupTarget:', BackupTarget)
+    print('*** NetworkType:', NetworkType)
+    print('*** TagList:', TagList)
+
+    return (DBInstanceClass, Port, AvailabilityZone, DBSubnetGroupName, MultiAZ, PubliclyAccessible, AutoMinorVersionUpgrade, LicenseModel,
+            Engine, OptionGroupName, StorageType, VpcSecurityGroupIdsList, DBParameterGroupName, BackupTarget, NetworkType, TagList)
+
+
+def refresh_workflow(targets, blue_green=False, existing_snapshot=None):
+    """
+    Declares the refresh of the target environments as one workflow.
+
+    A single production snapshot is taken for all targets, or
+    existing_snapshot is used and none is taken. The old targets are only
+    deleted once the snapshot is there, so a failed snapshot leaves them
+    untouched. Then every target's delete and restore run side by side with
+    the other targets', so the refresh of many targets takes one snapshot
+    plus the slowest delete and restore. With blue_green each target's
+    restore and swap follow the snapshot instead, see blue_green_restore.
+
+    Args:
+        targets (dict): Target identifier -> its restore args, see get_restore_args.
+        blue_green (bool): Restore next to the targets and swap by renaming.
+        existing_snapshot (str): Identifier of a production snapshot to restore.
+    """
+    # an instance that is still backing up or modifying refuses the delete for a while
+    retry = RetryPolicy(attempts=3, delay=60,
+                        retry_on=(client.exceptions.InvalidDBInstanceStateFault,))
+    if existing_snapshot:
+        steps = [Step('snapshot', lambda results: existing_snapshot)]
+    else:
+        steps = [Step('snapshot', lambda results: take_snapshot())]
+
+    for target, restore_args in targets.items():
+        # the loop variables are bound as defaults, the actions run after the loop
+        if blue_green:
+            steps.append(Step(f'blue_green_restore:{target}',
+                              lambda results, target=target, restore_args=restore_args: blue_green_restore(
+                                  *restore_args, instance_identifier=target,
+                                  snapshot_identifier=results['snapshot']),
+                              after=['snapshot']))
+            continue
+        steps.append(Step(f'delete:{target}', lambda results, target=target: delete_db(target),
+                          after=['snapshot'], retry=retry))
+        steps.append(Step(f'restore:{target}',
+                          lambda results, target=target, restore_args=restore_args: restore_snapshot(
+                              *restore_args, instance_identifier=target,
+                              snapshot_identifier=results['snapshot']),
+                          after=['snapshot', f'delete:{target}']))
+    return Workflow('refresh', steps)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Refresh the target environments from one production snapshot')
+    parser.add_argument('targets', nargs='*', default=[target_env_identifier],
+                        help=f'identifiers of the instances to refresh (default: {target_env_identifier})')
+    parser.add_argument('--blue-green', action='store_true',
+                        help='restore next to the target and swap by renaming instead of delete then restore')
+    parser.add_argument('--snapshot',
+                        help="restore this production snapshot instead of taking a new one, "
+                             "'latest' for the newest available")
+    args = parser.parse_args()
+    targets = list(dict.fromkeys(args.targets))
+    if prd_identifier in targets:
+        parser.error(f'{prd_identifier} is the source of the refresh, not a target')
+
+    print('*** Process Started')
+    # every target is described before anything is changed, so a wrong identifier stops the run early
+    restore_args = {target: get_restore_args(target) for target in targets}
+    existing_snapshot = latest_snapshot() if args.snapshot == 'latest' else args.snapshot
+
+    workflow = refresh_workflow(restore_args, args.blue_green, existing_snapshot)
+    # every step mostly waits on a boto3 waiter, give each its own thread
+    with ThreadPoolExecutor(max_workers=len(workflow.steps)) as executor:
+        workflow.run(executor)
+    print('*** Process Finished Successfully')
+
+
+if __name__ == '__main__':
+    main()
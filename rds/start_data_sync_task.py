@@ -1,37 +1,111 @@
-import boto3
+import argparse
+import logging
+import os
+import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 
-client = boto3.client('datasync')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import lazy_client
+from common.polling import poll
 
-Task1_ARN = "ARN"
-Task2_ARN = "ARN"
+client = lazy_client('datasync')
 
-client.start_task_execution(TaskArn=Task1_ARN)
-client.start_task_execution(TaskArn=Task2_ARN)
 
-def get_status(arn):
-    response = client.describe_task_execution(TaskExecutionArn=arn)
-    status = response['Status']
-    return status
+def start_execution(task_arn):
+    response = client.start_task_execution(TaskArn=task_arn)
+    execution_arn = response['TaskExecutionArn']
+    print(f"*** started {task_arn}, execution: {execution_arn}")
+    return execution_arn
 
-status_t1 = get_status(Task1_ARN)
-status_t2 = get_status(Task2_ARN)
 
-while True:    
-    print("status task1:", status_t1)
-    print("status task2:", status_t2)
-    if status_t1 == 'SUCCESS' and status_t2 =='SUCCESS':
-        print("*** tasks succeeded")
-        break
-    elif status_t1 == 'ERROR' or status_t2 =='ERROR':
+def get_execution(execution_arn):
+    return client.describe_task_execution(TaskExecutionArn=execution_arn)
+
+
+def elapsed_seconds(execution):
+    # TotalDuration is only filled in once the execution has finished
+    total_duration = execution.get('Result', {}).get('TotalDuration')
+    if total_duration:
+        return total_duration / 1000
+    if 'StartTime' in execution:
+        return (datetime.now(timezone.utc) - execution['StartTime']).total_seconds()
+    return 0
+
+
+def throughput(bytes_transferred, seconds):
+    """Returns the effective transfer rate in MB/s."""
+    return bytes_transferred / 1024 / 1024 / seconds if seconds else 0
+
+
+def progress(execution):
+    bytes_transferred = execution.get('BytesTransferred', 0)
+    return (f"{execution['Status']}, {execution.get('FilesTransferred', 0)} files, "
+            f"{bytes_transferred / 1024 / 1024:.1f} MB, "
+            f"{throughput(bytes_transferred, elapsed_seconds(execution)):.2f} MB/s")
+
+
+def run_task(task_arn):
+    """
+    Starts one execution of the task and waits for it to finish.
+
+    Returns:
+        dict: The last describe_task_execution response, or a bare ERROR
+            status when the execution could not be started or described.
+    """
+    execution_arn = None
+    try:
+        execution_arn = start_execution(task_arn)
+        return poll(lambda: get_execution(execution_arn),
+                    is_done=lambda e: e['Status'] == 'SUCCESS',
+                    is_failed=lambda e: e['Status'] == 'ERROR',
+                    description=f'execution {execution_arn}',
+                    timeout=24 * 3600, delay=5, max_delay=60, status=progress)
+    except Exception as e:
+        print(f"***ERROR*** {task_arn}: {e}")
+    if execution_arn:
+        try:
+            return get_execution(execution_arn)
+        except Exception as e:
+            print(f"***ERROR*** {task_arn}: {e}")
+    return {'Status': 'ERROR'}
+
+
+def print_report(task_arns, executions, seconds):
+    print(f"{'TASK':<70} {'STATUS':<12} {'FILES':>10} {'MB':>12} {'MB/s':>8}")
+    for task_arn, execution in zip(task_arns, executions):
+        bytes_transferred = execution.get('BytesTransferred', 0)
+        print(f"{task_arn:<70} {execution['Status']:<12} {execution.get('FilesTransferred', 0):>10} "
+              f"{bytes_transferred / 1024 / 1024:>12.1f} "
+              f"{throughput(bytes_transferred, elapsed_seconds(execution)):>8.2f}")
+
+    total_bytes = sum(e.get('BytesTransferred', 0) for e in executions)
+    total_files = sum(e.get('FilesTransferred', 0) for e in executions)
+    print(f"{'TOTAL':<70} {'':<12} {total_files:>10} {total_bytes / 1024 / 1024:>12.1f} "
+          f"{throughput(total_bytes, seconds):>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run DataSync tasks concurrently and report their throughput')
+    parser.add_argument('task_arns', nargs='+', help='ARNs of the tasks to run')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=len(args.task_arns)) as executor:
+        executions = list(executor.map(run_task, args.task_arns))
+
+    print_report(args.task_arns, executions, time.monotonic() - started)
+
+    if any(e['Status'] != 'SUCCESS' for e in executions):
         print("***ERROR***")
-        print("status task1:", status_t1)
-        print("status task2:", status_t2)
         raise Exception('Please check the failed tasks')
-    else:
-        status_t1 = get_status(Task1_ARN)
-        status_t2 = get_status(Task2_ARN)
-        print("status task1:", status_t1)
-        print("status task2:", status_t2)
-        time.sleep(5)
+    print("*** tasks succeeded")
+
 
+if __name__ == '__main__':
+    main()
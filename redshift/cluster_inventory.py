@@ -0,0 +1,105 @@
+import threading
+import time
+
+
+class ClusterInventory:
+    """
+    In-memory index of the Redshift clusters of one account and region.
+
+    Clusters are keyed by ClusterIdentifier and loaded from a paginated
+    describe_clusters. The whole index is reloaded when it is older than ttl
+    seconds; a single cluster can be refreshed on its own with one targeted call.
+    """
+
+    def __init__(self, redshift_client, ttl=300):
+        self.redshift_client = redshift_client
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._clusters = {}
+        self._loaded_at = None
+
+    def refresh(self):
+        """
+        Reloads every cluster of the account.
+
+        Returns:
+            None
+        """
+        clusters = {}
+        paginator = self.redshift_client.get_paginator('describe_clusters')
+        for page in paginator.paginate():
+            for cluster in page['Clusters']:
+                clusters[cluster['ClusterIdentifier']] = cluster
+
+        with self._lock:
+            self._clusters = clusters
+            self._loaded_at = time.monotonic()
+
+    def refresh_cluster(self, cluster_name):
+        """
+        Reloads one cluster, dropping it from the index if it no longer exists.
+
+        Args:
+            cluster_name (str): The name of the Redshift cluster.
+
+        Returns:
+            dict: The cluster description, or None if the cluster does not exist.
+        """
+        try:
+            response = self.redshift_client.describe_clusters(
+                ClusterIdentifier=cluster_name)
+            cluster = response['Clusters'][0]
+        except self.redshift_client.exceptions.ClusterNotFoundFault:
+            cluster = None
+
+        with self._lock:
+            if cluster is None:
+                self._clusters.pop(cluster_name, None)
+            else:
+                self._clusters[cluster_name] = cluster
+        return cluster
+
+    def get(self, cluster_name):
+        """
+        Returns the cached description of a cluster.
+
+        Args:
+            cluster_name (str): The name of the Redshift cluster.
+
+        Returns:
+            dict: The cluster description, or None if the cluster does not exist.
+        """
+        with self._lock:
+            expired = self._loaded_at is None or time.monotonic() - self._loaded_at > self.ttl
+        if expired:
+            self.refresh()
+
+        with self._lock:
+            return self._clusters.get(cluster_name)
+
+    def discard(self, cluster_name):
+        with self._lock:
+            self._clusters.pop(cluster_name, None)
+
+    def __contains__(self, cluster_name):
+        return self.get(cluster_name) is not None
+
+
+_inventories = {}
+_inventories_lock = threading.Lock()
+
+
+def inventory_for(redshift_client):
+    """
+    Returns the inventory shared by every caller using the same client.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+
+    Returns:
+        ClusterInventory: The inventory of the client's account and region.
+    """
+    with _inventories_lock:
+        if redshift_client not in _inventories:
+            _inventories[redshift_client] = ClusterInventory(redshift_client)
+        return _inventories[redshift_client]
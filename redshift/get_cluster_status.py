@@ -1,7 +1,12 @@
-import logging
-import boto3
+import argparse
+import os
+import sys
 import time
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import get_client
+from common.describe_cache import live
+
 def get_cluster_status(redshift_client, cluster_name):
     """
     Gets the current status of the specified Redshift cluster.
@@ -13,16 +18,27 @@ def get_cluster_status(redshift_client, cluster_name):
     Returns:
         str: The current status of the cluster.
     """
-    response = redshift_client.describe_clusters(ClusterIdentifier=cluster_name)
+    with live():
+        response = redshift_client.describe_clusters(ClusterIdentifier=cluster_name)
     
     return response['Clusters'][0]['ClusterStatus']
 
-session = boto3.Session(profile_name="DEV", region_name='ap-south-1')
-redshift_client = session.client('redshift')
 
-cluster_name = "redshift-cluster-1"
+def main():
+    parser = argparse.ArgumentParser(description='Poll the status of a Redshift cluster')
+    parser.add_argument('--cluster', default="redshift-cluster-1")
+    parser.add_argument('--profile', default="DEV")
+    parser.add_argument('--region', default='ap-south-1')
+    parser.add_argument('--interval', type=float, default=1,
+                        help='seconds between two status checks')
+    args = parser.parse_args()
+
+    redshift_client = get_client('redshift', profile_name=args.profile, region_name=args.region)
+    while True:
+        time.sleep(args.interval)
+        status = get_cluster_status(redshift_client, args.cluster)
+        print(status)
+
 
-while True:
-    time.sleep(1)
-    status = get_cluster_status(redshift_client, cluster_name)
-    print(status)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -1,11 +1,31 @@
+import argparse
+import csv
 import logging
-import boto3
-import time
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from common.aws_clients import get_client
+from common.describe_cache import live
+from common.polling import poll
+from common.workflow import RetryPolicy, Step, Workflow, run_all
+from redshift.cluster_inventory import inventory_for
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger()
 
+# cluster states that will not turn into another state by waiting
+CLUSTER_ERROR_STATES = {'hardware-failure', 'incompatible-hsm', 'incompatible-network',
+                        'incompatible-parameters', 'incompatible-restore', 'storage-full'}
+SNAPSHOT_ERROR_STATES = {'failed', 'deleted'}
+
+# how far back Redshift keeps cluster events
+EVENT_RETENTION = timedelta(days=14)
+# the pause snapshot is started with the pause, its event can be written a little later
+PAUSE_SNAPSHOT_LEAD = timedelta(minutes=5)
+
 
 def is_aws_profile_available(profile_name):
     """
@@ -18,8 +38,7 @@ def is_aws_profile_available(profile_name):
         bool: True if the profile is available, False otherwise.
     """
     try:
-        session = boto3.Session(profile_name=profile_name)
-        session.client('sts').get_caller_identity()
+        get_client('sts', profile_name=profile_name).get_caller_identity()
         return True
     except Exception as e:
         logger.warning(
@@ -40,9 +59,10 @@ def check_cluster_availability(redshift_client, cluster_name):
     """
 
     try:
-        all_cluster_state = redshift_client.describe_clusters()['Clusters']
+        inventory = inventory_for(redshift_client)
 
-        if cluster_name in str(all_cluster_state):
+        # a cluster created after the last full load needs one targeted lookup
+        if cluster_name in inventory or inventory.refresh_cluster(cluster_name):
             logger.info(f"Cluster '{cluster_name}' is present in environment")
             return True
         else:
@@ -64,13 +84,15 @@ def get_cluster_status(redshift_client, cluster_name):
     Returns:
         str: The current status of the cluster.
     """
-    response = redshift_client.describe_clusters(
-        ClusterIdentifier=cluster_name)
+    # decisions are made on it, it must not come from the describe cache
+    with live():
+        response = redshift_client.describe_clusters(
+            ClusterIdentifier=cluster_name)
 
     return response['Clusters'][0]['ClusterStatus']
 
 
-def wait_for_cluster_status(redshift_client, cluster_name, target_status):
+def wait_for_cluster_status(redshift_client, cluster_name, target_status, timeout=3600):
     """
     Waits for the specified Redshift cluster to reach the target status.
 
@@ -78,20 +100,73 @@ def wait_for_cluster_status(redshift_client, cluster_name, target_status):
         redshift_client (boto3.client): The Redshift client.
         cluster_name (str): The name of the Redshift cluster.
         target_status (str): The target status to wait for.
+        timeout (int): Seconds to wait before giving up.
 
     Returns:
         None
     """
-    while True:
-        cluster_status = get_cluster_status(redshift_client, cluster_name)
-        if cluster_status == target_status:
-            logger.info(
-                f"Cluster '{cluster_name}' is now in '{target_status}' status")
-            break
-        else:
-            logger.info(
-                f"Waiting for cluster '{cluster_name}' to reach '{target_status}' status (current status: {cluster_status})...")
-            time.sleep(10)
+    poll(lambda: get_cluster_status(redshift_client, cluster_name),
+         is_done=lambda status: status == target_status,
+         is_failed=lambda status: status in CLUSTER_ERROR_STATES or
+         (status == 'deleting' and target_status != 'deleted'),
+         description=f"cluster '{cluster_name}' to reach '{target_status}' status",
+         timeout=timeout)
+    logger.info(
+        f"Cluster '{cluster_name}' is now in '{target_status}' status")
+
+
+def wait_for_cluster_deleted(redshift_client, cluster_name, timeout=3600):
+    """
+    Waits until the specified Redshift cluster no longer exists.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+        cluster_name (str): The name of the Redshift cluster.
+        timeout (int): Seconds to wait before giving up.
+
+    Returns:
+        None
+    """
+    def fetch():
+        try:
+            return get_cluster_status(redshift_client, cluster_name)
+        except redshift_client.exceptions.ClusterNotFoundFault:
+            return 'deleted'
+
+    poll(fetch,
+         is_done=lambda status: status == 'deleted',
+         is_failed=lambda status: status in CLUSTER_ERROR_STATES,
+         description=f"cluster '{cluster_name}' to be deleted",
+         timeout=timeout)
+    inventory_for(redshift_client).discard(cluster_name)
+    logger.info(f"Cluster '{cluster_name}' has been deleted")
+
+
+def wait_for_snapshot_status(redshift_client, snapshot_identifier, target_status, timeout=7200):
+    """
+    Waits for the specified manual cluster snapshot to reach the target status.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+        snapshot_identifier (str): The identifier of the snapshot.
+        target_status (str): The target status to wait for.
+        timeout (int): Seconds to wait before giving up.
+
+    Returns:
+        None
+    """
+    def fetch():
+        response = redshift_client.describe_cluster_snapshots(
+            SnapshotIdentifier=snapshot_identifier,
+            SnapshotType='manual'
+        )
+        return response['Snapshots'][0]['Status']
+
+    poll(fetch,
+         is_done=lambda status: status == target_status,
+         is_failed=lambda status: status in SNAPSHOT_ERROR_STATES,
+         description=f"snapshot '{snapshot_identifier}' to become {target_status}",
+         timeout=timeout)
 
 
 def resume_cluster(redshift_client, cluster_name):
@@ -116,10 +191,116 @@ def resume_cluster(redshift_client, cluster_name):
     logger.info(f"Cluster '{cluster_name}' has been resumed")
 
 
+def get_pause_start(redshift_client, cluster_name):
+    """
+    Finds when the current pause of the specified Redshift cluster started.
+
+    The start is the first pause event (pausing, then paused) after the
+    last resume event, as Redshift takes the pause snapshot when the pause
+    starts, before the pause is complete.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+        cluster_name (str): The name of the Redshift cluster.
+
+    Returns:
+        tuple: The start of the pause and the last resume before it (None
+        when there is none); None if the pause is older than the event retention.
+    """
+    events = []
+    paginator = redshift_client.get_paginator('describe_events')
+    pages = paginator.paginate(SourceIdentifier=cluster_name, SourceType='cluster',
+                               StartTime=datetime.now(timezone.utc) - EVENT_RETENTION)
+    for page in pages:
+        events += page['Events']
+
+    paused_at = resumed_at = None
+    for event in sorted(events, key=lambda event: event['Date']):
+        message = event['Message'].lower()
+        if 'resum' in message:
+            paused_at, resumed_at = None, event['Date']
+        elif 'paus' in message and paused_at is None:
+            paused_at = event['Date']
+    if paused_at is None:
+        return None
+    return paused_at, resumed_at
+
+
+def copy_pause_snapshot(redshift_client, cluster_name, snapshot_identifier, retention_period):
+    """
+    Copies the automated snapshot taken when the cluster was paused to a manual snapshot.
+
+    Redshift takes a snapshot when a pause starts and no automated
+    snapshots while the cluster is paused. Nothing is written to a paused
+    cluster, so the most recent automated snapshot started around the
+    start of the pause (within PAUSE_SNAPSHOT_LEAD before it, and after the
+    last resume) holds all of its data and the cluster does not need to be
+    resumed for a final snapshot.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+        cluster_name (str): The name of the Redshift cluster.
+        snapshot_identifier (str): The identifier for the manual snapshot.
+        retention_period (int): The retention period for the snapshot in days.
+
+    Returns:
+        bool: True if the snapshot was copied, False if there is no snapshot
+        known to be taken after the pause.
+    """
+    try:
+        pause = get_pause_start(redshift_client, cluster_name)
+    except Exception as e:
+        logger.warning(f"Failed to find when cluster '{cluster_name}' was paused: {e}")
+        return False
+    if pause is None:
+        logger.info(f"No pause event found for cluster '{cluster_name}'")
+        return False
+    paused_at, resumed_at = pause
+    not_before = paused_at - PAUSE_SNAPSHOT_LEAD
+    if resumed_at is not None and resumed_at > not_before:
+        not_before = resumed_at
+
+    latest = None
+    paginator = redshift_client.get_paginator('describe_cluster_snapshots')
+    pages = paginator.paginate(ClusterIdentifier=cluster_name, SnapshotType='automated',
+                               StartTime=not_before)
+    for page in pages:
+        for snapshot in page['Snapshots']:
+            if snapshot['Status'] == 'available' and snapshot['SnapshotCreateTime'] >= not_before and \
+                    (latest is None or snapshot['SnapshotCreateTime'] > latest['SnapshotCreateTime']):
+                latest = snapshot
+    if latest is None:
+        logger.info(f"No automated snapshot of cluster '{cluster_name}' taken for its pause at {paused_at}")
+        return False
+
+    logger.info(
+        f"Copying automated snapshot '{latest['SnapshotIdentifier']}' of paused cluster "
+        f"'{cluster_name}' to '{snapshot_identifier}'...")
+    try:
+        redshift_client.copy_cluster_snapshot(
+            SourceSnapshotIdentifier=latest['SnapshotIdentifier'],
+            SourceSnapshotClusterIdentifier=cluster_name,
+            TargetSnapshotIdentifier=snapshot_identifier,
+            ManualSnapshotRetentionPeriod=retention_period
+        )
+    except Exception as e:
+        logger.warning(f"Failed to copy snapshot '{latest['SnapshotIdentifier']}': {e}")
+        return False
+
+    wait_for_snapshot_status(redshift_client, snapshot_identifier, 'available')
+
+    logger.info(
+        f"Snapshot '{snapshot_identifier}' is available with a retention period of {retention_period} days")
+    return True
+
+
 def take_final_snapshot(redshift_client, cluster_name, snapshot_identifier, retention_period):
     """
     Takes a final snapshot of the specified Redshift cluster.
 
+    A paused cluster is only resumed for it when copy_pause_snapshot finds
+    no automated snapshot to copy.
+
     Args:
         redshift_client (boto3.client): The Redshift client.
         cluster_name (str): The name of the Redshift cluster.
@@ -132,6 +313,8 @@ def take_final_snapshot(redshift_client, cluster_name, snapshot_identifier, rete
 
     cluster_status = get_cluster_status(redshift_client, cluster_name)
     if cluster_status == 'paused':
+        if copy_pause_snapshot(redshift_client, cluster_name, snapshot_identifier, retention_period):
+            return
         resume_cluster(redshift_client, cluster_name)
 
     wait_for_cluster_status(redshift_client, cluster_name, 'available')
@@ -144,16 +327,7 @@ def take_final_snapshot(redshift_client, cluster_name, snapshot_identifier, rete
         ClusterIdentifier=cluster_name
     )
 
-    snapshot_status = ''
-    while snapshot_status != 'available':
-        response = redshift_client.describe_cluster_snapshots(
-            SnapshotIdentifier=snapshot_identifier,
-            SnapshotType='manual'
-        )
-        snapshot_status = response['Snapshots'][0]['Status']
-        logger.info(
-            f"Waiting for snapshot '{snapshot_identifier}' to become available (current status: {snapshot_status})...")
-        time.sleep(10)
+    wait_for_snapshot_status(redshift_client, snapshot_identifier, 'available')
 
     logger.info(f"Snapshot '{snapshot_identifier}' is available for use")
 
@@ -165,59 +339,208 @@ def take_final_snapshot(redshift_client, cluster_name, snapshot_identifier, rete
     logger.info(
         f"Snapshot '{snapshot_identifier}' retention period has been set to {retention_period} days")
 
-    time.sleep(30)
 
-
-def delete_cluster(redshift_client, cluster_name):
+def delete_cluster(redshift_client, cluster_name, snapshot_identifier=None, retention_period=None):
     """
     Terminate the specified Redshift cluster.
 
+    With a snapshot_identifier Redshift takes the final snapshot itself as
+    part of the delete, so there is only the wait for the deletion.
+
     Args:
         redshift_client (botocore.client.Redshift): An instance of boto3 Redshift client.
         cluster_name (str): The name of the Redshift cluster to terminate.
+        snapshot_identifier (str): The identifier for the final snapshot, None to skip it.
+        retention_period (int): The retention period for the final snapshot in days.
 
     Returns:
         None
     """
+    if snapshot_identifier:
+        snapshot_args = {'FinalClusterSnapshotIdentifier': snapshot_identifier,
+                         'FinalClusterSnapshotRetentionPeriod': retention_period}
+    else:
+        snapshot_args = {'SkipFinalClusterSnapshot': True}
 
     logger.info(f"Checking cluster state '{cluster_name}'")
 
-    cluster_state = get_cluster_status(redshift_client, cluster_name)
-
-    logger.info(f"Cluster '{cluster_name}' is now in '{cluster_state}' status")
-
-    while cluster_state != 'available':
-        time.sleep(10)
+    # a paused cluster can be deleted as it is
+    if get_cluster_status(redshift_client, cluster_name) != 'paused':
         wait_for_cluster_status(redshift_client, cluster_name, 'available')
 
     logger.info(f"Terminating cluster '{cluster_name}'")
 
-    try:
-        response = redshift_client.delete_cluster(
-            ClusterIdentifier=cluster_name,
-            SkipFinalClusterSnapshot=True
-        )
+    def request_delete():
+        try:
+            redshift_client.delete_cluster(
+                ClusterIdentifier=cluster_name,
+                **snapshot_args
+            )
+            return True
+        except redshift_client.exceptions.InvalidClusterStateFault as e:
+            logger.error(f"There was an error: {e}")
+            return False
 
-    except Exception as e:
-        logger.error(f"There was an error: {e}")
-        time.sleep(10)
-        delete_cluster(redshift_client, cluster_name)
-
-    cluster_state = get_cluster_status(redshift_client, cluster_name)
-    cluster_availability = check_cluster_availability(
-        redshift_client, cluster_name)
-
-    while cluster_state != 'deleted' and cluster_availability is True:
-        time.sleep(10)
-        cluster_availability = check_cluster_availability(
-            redshift_client, cluster_name)
-        if cluster_availability:
-            cluster_state = get_cluster_status(redshift_client, cluster_name)
-            logger.info(
-                f"Waiting for cluster '{cluster_name}' to be deleted. Current status: '{cluster_state}'")
+    # the cluster can still be busy right after the snapshot, retry until it accepts
+    poll(request_delete, is_done=bool,
+         description=f"cluster '{cluster_name}' to accept the delete request",
+         timeout=600)
 
-    logger.info(f"Cluster '{cluster_name}' has been deleted")
-    exit(1)
+    wait_for_cluster_deleted(redshift_client, cluster_name)
+
+    if snapshot_identifier:
+        logger.info(
+            f"Final snapshot '{snapshot_identifier}' kept for {retention_period} days")
+
+
+def decommission_workflow(redshift_client, cluster_name, retention_period, snapshot_on_delete=False):
+    """
+    Declares taking the final snapshot of a cluster and terminating it as a workflow.
+
+    With snapshot_on_delete the snapshot of an available cluster is left to
+    the delete_cluster call instead of being taken and waited for first. A
+    paused cluster still gets the copy of its pause snapshot when there is
+    one, and is resumed for the final snapshot delete otherwise.
+
+    Args:
+        redshift_client (boto3.client): The Redshift client.
+        cluster_name (str): The name of the Redshift cluster.
+        retention_period (int): The retention period for the snapshot in days.
+        snapshot_on_delete (bool): Take the final snapshot as part of the delete.
+
+    Returns:
+        common.workflow.Workflow: The 'delete' step results in the final snapshot identifier.
+    """
+    snapshot_identifier = f"{cluster_name}-final-snapshot"
+    # a cluster that is busy (e.g. still taking an automated snapshot) refuses both steps for a while
+    retry = RetryPolicy(attempts=3, delay=60,
+                        retry_on=(redshift_client.exceptions.InvalidClusterStateFault,))
+
+    if not snapshot_on_delete:
+        def final_snapshot(results):
+            take_final_snapshot(redshift_client, cluster_name,
+                                snapshot_identifier, retention_period)
+
+        def delete(results):
+            delete_cluster(redshift_client, cluster_name)
+            return snapshot_identifier
+
+        return Workflow(cluster_name, [
+            Step('final_snapshot', final_snapshot, retry=retry),
+            Step('delete', delete, after=['final_snapshot'], retry=retry),
+        ])
+
+    def prepare(results):
+        """Returns True when the final snapshot is already taken."""
+        if get_cluster_status(redshift_client, cluster_name) != 'paused':
+            return False
+        if copy_pause_snapshot(redshift_client, cluster_name, snapshot_identifier, retention_period):
+            return True
+        resume_cluster(redshift_client, cluster_name)
+        return False
+
+    def delete(results):
+        if results['prepare']:
+            delete_cluster(redshift_client, cluster_name)
+        else:
+            delete_cluster(redshift_client, cluster_name, snapshot_identifier, retention_period)
+        return snapshot_identifier
+
+    return Workflow(cluster_name, [
+        Step('prepare', prepare, retry=retry),
+        Step('delete', delete, after=['prepare'], retry=retry),
+    ])
+
+
+def decommission_cluster(redshift_client, cluster_name, retention_period, snapshot_on_delete=False):
+    """
+    Takes the final snapshot of a cluster and terminates it, see decommission_workflow.
+
+    Returns:
+        str: The identifier of the final snapshot.
+    """
+    workflow = decommission_workflow(redshift_client, cluster_name, retention_period,
+                                     snapshot_on_delete)
+    return workflow.run()['delete']
+
+
+def decommission_clusters(targets, retention_period, max_workers=10, region_name='ap-south-1',
+                          snapshot_on_delete=False):
+    """
+    Decommissions many clusters in parallel.
+
+    A cluster that fails, or whose profile or cluster cannot be found, is
+    reported in the summary and does not stop the others.
+
+    Args:
+        targets (list): (cluster_name, profile_name) pairs.
+        retention_period (int): The retention period for the snapshots in days.
+        max_workers (int): The number of clusters decommissioned at the same time.
+        region_name (str): The region of the clusters.
+        snapshot_on_delete (bool): Take the final snapshots as part of the deletes.
+
+    Returns:
+        list: One summary dict per cluster.
+    """
+    results = []
+    workflows = []
+    profiles = {}
+    for cluster_name, profile_name in targets:
+        result = {'cluster': cluster_name, 'profile': profile_name,
+                  'status': '', 'snapshot': '', 'seconds': 0}
+        results.append(result)
+
+        if profile_name not in profiles:
+            profiles[profile_name] = is_aws_profile_available(profile_name)
+        if not profiles[profile_name]:
+            result['status'] = 'profile not available'
+            continue
+
+        redshift_client = get_client('redshift', profile_name=profile_name,
+                                     region_name=region_name)
+
+        if not check_cluster_availability(redshift_client, cluster_name):
+            result['status'] = 'cluster not found'
+            continue
+
+        workflows.append((decommission_workflow(redshift_client, cluster_name, retention_period,
+                                                snapshot_on_delete), result))
+
+    runs = run_all([workflow for workflow, _ in workflows], max_concurrency=max_workers)
+    for run, (_, result) in zip(runs, workflows):
+        if run.ok:
+            result['snapshot'] = run.results['delete']
+            result['status'] = 'deleted'
+        else:
+            logger.error(f"Failed to decommission cluster '{result['cluster']}': {run.error}")
+            result['status'] = f'failed: {run.error.error}'
+        result['seconds'] = round(run.seconds)
+
+    return results
+
+
+def read_targets(path):
+    """
+    Reads the clusters to decommission from a csv with cluster_name and profile_name columns.
+
+    Args:
+        path (str): The path of the csv file.
+
+    Returns:
+        list: (cluster_name, profile_name) pairs.
+    """
+    with open(path, newline='') as csvfile:
+        return [(row['cluster_name'].strip(), row['profile_name'].strip())
+                for row in csv.DictReader(csvfile)]
+
+
+def print_summary(results):
+    header = f"{'CLUSTER':<40} {'PROFILE':<8} {'SECONDS':>7}  {'SNAPSHOT':<55} STATUS"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['cluster']:<40} {result['profile']:<8} {result['seconds']:>7}  "
+              f"{result['snapshot']:<55} {result['status']}")
 
 
 def main():
@@ -225,38 +548,43 @@ def main():
     The main function for the script. Prompts the user for the Redshift cluster name and AWS credentials profile, checks if the
     cluster is in a paused state, takes a final snapshot with a specified retention period, and terminates the cluster.
 
+    With --targets the clusters and profiles are read from a csv instead and decommissioned in parallel,
+    followed by a summary table.
+
     Args:
         None
 
     Returns:
         None
     """
-    cluster_name = input("Enter Redshift cluster name: ")
-    profile_name = input(
-        "Enter AWS credentials profile name(DEV,TEST,UAT,PROD): ")
-
-    if is_aws_profile_available(profile_name):
-        pass
+    parser = argparse.ArgumentParser(
+        description='Take a final snapshot of Redshift clusters and terminate them')
+    parser.add_argument('--targets',
+                        help='csv with cluster_name and profile_name columns, skips the prompts')
+    parser.add_argument('--workers', type=int, default=10,
+                        help='number of clusters decommissioned at the same time')
+    parser.add_argument('--retention-period', type=int, default=90,
+                        help='retention of the final snapshots in days')
+    parser.add_argument('--snapshot-on-delete', action='store_true',
+                        help='let one delete_cluster call take the final snapshot instead of '
+                             'snapshotting and waiting before the delete')
+    args = parser.parse_args()
+
+    if args.targets:
+        targets = read_targets(args.targets)
     else:
-        exit(1)
-
-    retention_period = 90
+        cluster_name = input("Enter Redshift cluster name: ")
+        profile_name = input(
+            "Enter AWS credentials profile name(DEV,TEST,UAT,PROD): ")
+        targets = [(cluster_name, profile_name)]
 
-    session = boto3.Session(profile_name=profile_name,
-                            region_name='ap-south-1')
-    redshift_client = session.client('redshift')
+    results = decommission_clusters(targets, args.retention_period, args.workers,
+                                    snapshot_on_delete=args.snapshot_on_delete)
 
-    if check_cluster_availability(redshift_client, cluster_name):
-        pass
-    else:
+    print_summary(results)
+    if any(result['status'] != 'deleted' for result in results):
         exit(1)
 
-    snapshot_identifier = f"{cluster_name}-final-snapshot"
-    take_final_snapshot(redshift_client, cluster_name,
-                        snapshot_identifier, retention_period)
-
-    delete_cluster(redshift_client, cluster_name)
-
 
 if __name__ == '__main__':
     main()